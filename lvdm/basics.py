@@ -8,6 +8,7 @@
 # thanks!
 
 import torch.nn as nn
+from torch.nn.modules.dropout import _DropoutNd
 from utils.utils import instantiate_from_config
 
 
@@ -16,6 +17,43 @@ def disabled_train(self, mode=True):
     does not change anymore."""
     return self
 
+def prepare_for_inference(model, verbose=True):
+    """
+    Strip training-only machinery from a model that will only run inference:
+    gradient checkpointing is switched off (use_checkpoint / checkpoint flags, open_clip
+    grad_checkpointing), Dropout layers are replaced by Identity, disabled_train shims
+    are dropped and no parameter requires grad anymore. Returns the model; the count of
+    everything removed under each top-level submodule is printed when verbose.
+    """
+    report = {}
+    for name, child in model.named_children():
+        removed = {'checkpoint': 0, 'dropout': 0, 'shim': 0, 'frozen': 0}
+        for module in child.modules():
+            for flag in ('use_checkpoint', 'checkpoint', 'grad_checkpointing'):
+                if getattr(module, flag, None) is True:
+                    setattr(module, flag, False)
+                    removed['checkpoint'] += 1
+            for sub_name, sub_module in module.named_children():
+                if isinstance(sub_module, _DropoutNd):
+                    setattr(module, sub_name, nn.Identity())
+                    removed['dropout'] += 1
+            if module.__dict__.get('train') is disabled_train:
+                del module.train
+                removed['shim'] += 1
+        for param in child.parameters():
+            if param.requires_grad:
+                param.requires_grad_(False)
+                removed['frozen'] += param.numel()
+        report[name] = removed
+    ## the shimmed submodules only switch to eval mode now
+    model.eval()
+    if verbose:
+        for name, removed in report.items():
+            if any(removed.values()):
+                print(f">>> {name}: {removed['checkpoint']} checkpoint wrappers, {removed['dropout']} dropout layers, "
+                      f"{removed['shim']} train shims removed; {removed['frozen'] / 1e6:.1f}M parameters frozen")
+    return model
+
 def zero_module(module):
     """
     Zero out the parameters of a module and return it.
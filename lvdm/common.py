@@ -1,4 +1,5 @@
 import math
+from contextlib import contextmanager
 from inspect import isfunction
 import torch
 from torch import nn
@@ -77,6 +78,59 @@ def init_(tensor):
     tensor.uniform_(-std, std)
     return tensor
 
+class ContextCache(object):
+    """
+    Values derived from a conditioning tensor (e.g. projected text keys/values), kept
+    for one sampling run. Entries hold the tensor they were computed from, so they are
+    found by its identity, and are recomputed once it is edited in place (its version
+    moves on). Every key keeps its `slots` most recently used contexts (the conditional
+    and unconditional ones), so a context rebuilt on every call replaces its entry
+    instead of piling up.
+    """
+    def __init__(self, slots=2):
+        self.slots = slots
+        self.entries = {}
+
+    def get(self, context, key, compute):
+        entries = self.entries.setdefault(tuple(key), [])
+        for i, entry in enumerate(entries):
+            if entry[0] is context and entry[1] == context._version:
+                ## most recently used last
+                entries.append(entries.pop(i))
+                return entry[2]
+        entry = (context, context._version, compute())
+        entries.append(entry)
+        if len(entries) > self.slots:
+            entries.pop(0)
+        return entry[2]
+
+
+@contextmanager
+def context_cache(model):
+    ## every module of `model` with a `context_cache` slot caches into a fresh ContextCache within the block
+    modules = [module for module in model.modules() if hasattr(module, 'context_cache')]
+    for module in modules:
+        module.context_cache = ContextCache()
+    try:
+        yield
+    finally:
+        for module in modules:
+            module.context_cache = None
+
+
+@contextmanager
+def batch_groups(model, groups):
+    ## every module of `model` with a `batch_groups` slot treats its batch as `groups` independent groups within the block
+    modules = [module for module in model.modules() if hasattr(module, 'batch_groups')]
+    for module in modules:
+        module.batch_groups = groups
+    try:
+        yield
+    finally:
+        for module in modules:
+            module.batch_groups = 1
+
+
 ckpt = torch.utils.checkpoint.checkpoint
 def checkpoint(func, inputs, params, flag):
     """
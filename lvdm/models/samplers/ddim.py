@@ -1,8 +1,60 @@
 import numpy as np
 from tqdm import tqdm
 import torch
-from lvdm.models.utils_diffusion import make_ddim_sampling_parameters, make_ddim_timesteps
-from lvdm.common import noise_like
+from lvdm.models.utils_diffusion import make_ddim_timesteps
+from lvdm.common import noise_like, context_cache, batch_groups
+
+
+## columns of the per-step coefficient table of the DDIM update
+DDIM_COEFFICIENTS = ('recip_sqrt_alpha', 'sqrt_one_minus_alpha', 'recip_scale', 'x0_prev', 'dir_xt', 'sigma')
+
+
+def ddim_coefficients(alphas, alphas_prev, sigmas, scale=None, scale_prev=None):
+    """
+    Coefficient table (steps, k) of the DDIM update, columns as in DDIM_COEFFICIENTS.
+    With the latent rescaling (use_scale), pred_x0 is divided by scale_t and x_prev
+    is built from pred_x0 rescaled by scale_(t-1).
+    """
+    scale = torch.ones_like(alphas) if scale is None else scale
+    scale_prev = torch.ones_like(alphas) if scale_prev is None else scale_prev
+    return torch.stack([alphas.rsqrt(), (1. - alphas).sqrt(), 1. / scale,
+                        alphas_prev.sqrt() * scale_prev, (1. - alphas_prev - sigmas ** 2).sqrt(), sigmas], dim=1)
+
+
+def ddim_update(x, e_t, coefficients, noise=None, quantize=None):
+    """
+    One DDIM step from x_t and the predicted noise e_t, given the coefficient row of
+    the step (k,). The coefficients stay device scalars that broadcast over x, so the
+    step allocates no per-step tensors besides its outputs. Returns x_prev, pred_x0.
+    """
+    recip_sqrt_alpha, sqrt_one_minus_alpha, recip_scale, x0_prev, dir_xt, sigma = coefficients.unbind()
+    # current prediction for x_0
+    pred_x0 = torch.addcmul(x, e_t, sqrt_one_minus_alpha, value=-1.).mul_(recip_sqrt_alpha)
+    if quantize is not None:
+        pred_x0 = quantize(pred_x0)
+    pred_x0 = pred_x0.mul_(recip_scale)
+    # direction pointing to x_t, plus the rescaled x_0
+    x_prev = torch.addcmul(e_t * dir_xt, pred_x0, x0_prev)
+    if noise is not None:
+        x_prev.addcmul_(noise, sigma)
+    return x_prev, pred_x0
+
+
+def guidance_scale_at(guidance_scale, step, num_steps, guidance_interval=None):
+    """
+    Classifier-free guidance scale of sampling step `step` out of `num_steps` (0 is the
+    first, noisiest step). guidance_scale is a float or one scale per step. Outside
+    guidance_interval (start, end), i.e. for steps not in [start, end), guidance is off:
+    the scale is 1 and the unconditional pass is skipped.
+    """
+    if isinstance(guidance_scale, (list, tuple, np.ndarray)) and len(guidance_scale) != num_steps:
+        raise ValueError(f"got {len(guidance_scale)} guidance scales for {num_steps} sampling steps "
+                         f"(the uniform discretization of S steps can run S + 1 steps)")
+    if guidance_interval is not None and not guidance_interval[0] <= step < guidance_interval[1]:
+        return 1.
+    if isinstance(guidance_scale, (list, tuple, np.ndarray)):
+        return float(guidance_scale[step])
+    return guidance_scale
 
 
 class DDIMSampler(object):
@@ -12,52 +64,87 @@ class DDIMSampler(object):
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
         self.counter = 0
+        self._fused_conditioning = None
+        ## DDIM schedules by (steps, eta, discretization, device)
+        self.schedules = {}
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
-            if attr.device != torch.device("cuda"):
-                attr = attr.to(torch.device("cuda"))
+            if attr.device != self.model.betas.device:
+                attr = attr.to(self.model.betas.device)
         setattr(self, name, attr)
 
     def make_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
-        self.ddim_timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, num_ddim_timesteps=ddim_num_steps,
-                                                  num_ddpm_timesteps=self.ddpm_num_timesteps,verbose=verbose)
+        """
+        Set the DDIM schedule of `ddim_num_steps` steps as device tensors on the model's
+        device, always in float32. Schedules are built once per (steps, eta, discretization,
+        device) and reused by later calls, so repeated sample() calls cost a dict lookup.
+        """
+        key = (ddim_num_steps, ddim_eta, ddim_discretize, self.model.betas.device)
+        if key not in self.schedules:
+            self.schedules[key] = self.build_schedule(ddim_num_steps, ddim_discretize, ddim_eta, verbose)
+        for name, attr in self.schedules[key].items():
+            self.register_buffer(name, attr)
+
+    def build_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
+        ddim_timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, num_ddim_timesteps=ddim_num_steps,
+                                             num_ddpm_timesteps=self.ddpm_num_timesteps,verbose=verbose)
         alphas_cumprod = self.model.alphas_cumprod
         assert alphas_cumprod.shape[0] == self.ddpm_num_timesteps, 'alphas have to be defined for each timestep'
-        to_torch = lambda x: x.clone().detach().to(torch.float32).to(self.model.device)
-
-        self.register_buffer('betas', to_torch(self.model.betas))
-        self.register_buffer('alphas_cumprod', to_torch(alphas_cumprod))
-        self.register_buffer('alphas_cumprod_prev', to_torch(self.model.alphas_cumprod_prev))
-        self.use_scale = self.model.use_scale
-        print('DDIM scale', self.use_scale)
+        device = self.model.betas.device
+        to_torch = lambda x: x.clone().detach().to(device=device, dtype=torch.float32)
+        ## the ddim timesteps stay a numpy array (they are iterated on the host), everything else lives on the device
+        ddim_index = torch.as_tensor(ddim_timesteps, dtype=torch.long, device=device)
+        prev_index = torch.cat([ddim_index.new_zeros(1), ddim_index[:-1]])
+
+        schedule = {'ddim_timesteps': ddim_timesteps}
+        schedule['betas'] = to_torch(self.model.betas)
+        schedule['alphas_cumprod'] = alphas_cumprod = to_torch(alphas_cumprod)
+        schedule['alphas_cumprod_prev'] = alphas_cumprod_prev = to_torch(self.model.alphas_cumprod_prev)
+        schedule['use_scale'] = self.model.use_scale
+        if verbose:
+            print('DDIM scale', self.model.use_scale)
 
-        if self.use_scale:
-            self.register_buffer('scale_arr', to_torch(self.model.scale_arr))
-            ddim_scale_arr = self.scale_arr.cpu()[self.ddim_timesteps]
-            self.register_buffer('ddim_scale_arr', ddim_scale_arr)
-            ddim_scale_arr = np.asarray([self.scale_arr.cpu()[0]] + self.scale_arr.cpu()[self.ddim_timesteps[:-1]].tolist())
-            self.register_buffer('ddim_scale_arr_prev', ddim_scale_arr)
+        if self.model.use_scale:
+            schedule['scale_arr'] = scale_arr = to_torch(self.model.scale_arr)
+            schedule['ddim_scale_arr'] = scale_arr[ddim_index]
+            schedule['ddim_scale_arr_prev'] = scale_arr[prev_index]
 
         # calculations for diffusion q(x_t | x_{t-1}) and others
-        self.register_buffer('sqrt_alphas_cumprod', to_torch(np.sqrt(alphas_cumprod.cpu())))
-        self.register_buffer('sqrt_one_minus_alphas_cumprod', to_torch(np.sqrt(1. - alphas_cumprod.cpu())))
-        self.register_buffer('log_one_minus_alphas_cumprod', to_torch(np.log(1. - alphas_cumprod.cpu())))
-        self.register_buffer('sqrt_recip_alphas_cumprod', to_torch(np.sqrt(1. / alphas_cumprod.cpu())))
-        self.register_buffer('sqrt_recipm1_alphas_cumprod', to_torch(np.sqrt(1. / alphas_cumprod.cpu() - 1)))
-
-        # ddim sampling parameters
-        ddim_sigmas, ddim_alphas, ddim_alphas_prev = make_ddim_sampling_parameters(alphacums=alphas_cumprod.cpu(),
-                                                                                   ddim_timesteps=self.ddim_timesteps,
-                                                                                   eta=ddim_eta,verbose=verbose)
-        self.register_buffer('ddim_sigmas', ddim_sigmas)
-        self.register_buffer('ddim_alphas', ddim_alphas)
-        self.register_buffer('ddim_alphas_prev', ddim_alphas_prev)
-        self.register_buffer('ddim_sqrt_one_minus_alphas', np.sqrt(1. - ddim_alphas))
-        sigmas_for_original_sampling_steps = ddim_eta * torch.sqrt(
-            (1 - self.alphas_cumprod_prev) / (1 - self.alphas_cumprod) * (
-                        1 - self.alphas_cumprod / self.alphas_cumprod_prev))
-        self.register_buffer('ddim_sigmas_for_original_num_steps', sigmas_for_original_sampling_steps)
+        schedule['sqrt_alphas_cumprod'] = alphas_cumprod.sqrt()
+        schedule['sqrt_one_minus_alphas_cumprod'] = (1. - alphas_cumprod).sqrt()
+        schedule['log_one_minus_alphas_cumprod'] = (1. - alphas_cumprod).log()
+        schedule['sqrt_recip_alphas_cumprod'] = (1. / alphas_cumprod).sqrt()
+        schedule['sqrt_recipm1_alphas_cumprod'] = (1. / alphas_cumprod - 1).sqrt()
+
+        # ddim sampling parameters, according the the formula provided in https://arxiv.org/abs/2010.02502
+        ddim_alphas = alphas_cumprod[ddim_index]
+        ddim_alphas_prev = alphas_cumprod[prev_index]
+        ddim_sigmas = ddim_eta * torch.sqrt((1 - ddim_alphas_prev) / (1 - ddim_alphas) * (1 - ddim_alphas / ddim_alphas_prev))
+        if verbose:
+            print(f'Selected alphas for ddim sampler: a_t: {ddim_alphas}; a_(t-1): {ddim_alphas_prev}')
+            print(f'For the chosen value of eta, which is {ddim_eta}, '
+                  f'this results in the following sigma_t schedule for ddim sampler {ddim_sigmas}')
+        schedule['ddim_sigmas'] = ddim_sigmas
+        schedule['ddim_alphas'] = ddim_alphas
+        schedule['ddim_alphas_prev'] = ddim_alphas_prev
+        schedule['ddim_sqrt_one_minus_alphas'] = (1. - ddim_alphas).sqrt()
+        schedule['ddim_sigmas_for_original_num_steps'] = sigmas_for_original_steps = ddim_eta * torch.sqrt(
+            (1 - alphas_cumprod_prev) / (1 - alphas_cumprod) * (
+                        1 - alphas_cumprod / alphas_cumprod_prev))
+        schedule['ddim_eta'] = ddim_eta
+
+        ## per-step coefficient tables of the update, indexed by the step index
+        if self.model.use_scale:
+            scale_arr_prev = torch.cat([scale_arr[:1], scale_arr[:-1]])
+            ddim_scale = (schedule['ddim_scale_arr'], schedule['ddim_scale_arr_prev'])
+            original_scale = (scale_arr, scale_arr_prev)
+        else:
+            ddim_scale = original_scale = (None, None)
+        schedule['ddim_coefficients'] = ddim_coefficients(ddim_alphas, ddim_alphas_prev, ddim_sigmas, *ddim_scale)
+        schedule['original_coefficients'] = ddim_coefficients(alphas_cumprod, alphas_cumprod_prev,
+                                                              sigmas_for_original_steps, *original_scale)
+        return schedule
 
     @torch.no_grad()
     def sample(self,
@@ -111,22 +198,24 @@ class DDIMSampler(object):
             size = (batch_size, C, T, H, W)
         # print(f'Data shape for DDIM sampling is {size}, eta {eta}')
         
-        samples, intermediates = self.ddim_sampling(conditioning, size,
-                                                    callback=callback,
-                                                    img_callback=img_callback,
-                                                    quantize_denoised=quantize_x0,
-                                                    mask=mask, x0=x0,
-                                                    ddim_use_original_steps=False,
-                                                    noise_dropout=noise_dropout,
-                                                    temperature=temperature,
-                                                    score_corrector=score_corrector,
-                                                    corrector_kwargs=corrector_kwargs,
-                                                    x_T=x_T,
-                                                    log_every_t=log_every_t,
-                                                    unconditional_guidance_scale=unconditional_guidance_scale,
-                                                    unconditional_conditioning=unconditional_conditioning,
-                                                    verbose=verbose,
-                                                    **kwargs)
+        ## text keys/values are projected once per run and reused by every step
+        with context_cache(self.model):
+            samples, intermediates = self.ddim_sampling(conditioning, size,
+                                                        callback=callback,
+                                                        img_callback=img_callback,
+                                                        quantize_denoised=quantize_x0,
+                                                        mask=mask, x0=x0,
+                                                        ddim_use_original_steps=False,
+                                                        noise_dropout=noise_dropout,
+                                                        temperature=temperature,
+                                                        score_corrector=score_corrector,
+                                                        corrector_kwargs=corrector_kwargs,
+                                                        x_T=x_T,
+                                                        log_every_t=log_every_t,
+                                                        unconditional_guidance_scale=unconditional_guidance_scale,
+                                                        unconditional_conditioning=unconditional_conditioning,
+                                                        verbose=verbose,
+                                                        **kwargs)
         return samples, intermediates
 
     @torch.no_grad()
@@ -138,8 +227,7 @@ class DDIMSampler(object):
                       unconditional_guidance_scale=1., unconditional_conditioning=None, verbose=True,
                       cond_tau=1., target_size=None, start_timesteps=None,
                       **kwargs):
-        device = self.model.betas.device        
-        print('ddim device', device)
+        device = self.model.betas.device
         b = shape[0]
         if x_T is None:
             img = torch.randn(shape, device=device)
@@ -213,21 +301,49 @@ class DDIMSampler(object):
 
         return img, intermediates
 
-    @torch.no_grad()
-    def p_sample_ddim(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
-                      temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None,
-                      uc_type=None, conditional_guidance_scale_temporal=None, **kwargs):
-        b, *_, device = *x.shape, x.device
-        if x.dim() == 5:
-            is_video = True
+    def fused_conditioning(self, c, uc):
+        """
+        Conditioning of the fused classifier-free guidance pass: every tensor of c (a
+        tensor, or a dict of tensors and tensor lists such as c_crossattn and fps) is
+        concatenated with its unconditional counterpart along the batch dimension.
+        Built once per (c, uc) pair, so the same tensors are passed on every step.
+        """
+        if self._fused_conditioning is not None and self._fused_conditioning[0] is c and self._fused_conditioning[1] is uc:
+            return self._fused_conditioning[2]
+        if isinstance(c, torch.Tensor):
+            c_in = torch.cat([c, uc])
+        elif isinstance(c, dict):
+            c_in = dict()
+            for key in c:
+                if isinstance(c[key], list):
+                    c_in[key] = [torch.cat([c_i, uc_i]) for c_i, uc_i in zip(c[key], uc[key])]
+                elif isinstance(c[key], torch.Tensor):
+                    c_in[key] = torch.cat([c[key], uc[key]])
+                else:
+                    c_in[key] = c[key]
         else:
-            is_video = False
+            raise NotImplementedError
+        self._fused_conditioning = (c, uc, c_in)
+        return c_in
+
+    @torch.no_grad()
+    def guided_model_output(self, x, c, t, unconditional_guidance_scale=1., unconditional_conditioning=None,
+                            uc_type=None, conditional_guidance_scale_temporal=None, fused_cfg=False,
+                            score_corrector=None, corrector_kwargs=None, **kwargs):
+        """
+        Predicted noise e_t at x, t under classifier-free (and temporal) guidance.
+        """
         if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
             e_t = self.model.apply_model(x, t, c, **kwargs) # unet denoiser
         else:
             # with unconditional condition
-            if isinstance(c, torch.Tensor):
+            if fused_cfg:
+                ## both branches in one UNet pass over the doubled batch; the halves stay two groups
+                ## of their own in the FreePCA fusion, as in two separate passes
+                c_in = self.fused_conditioning(c, unconditional_conditioning)
+                with batch_groups(self.model, 2):
+                    e_t, e_t_uncond = self.model.apply_model(torch.cat([x, x]), torch.cat([t, t]), c_in, **kwargs).chunk(2)
+            elif isinstance(c, torch.Tensor):
                 e_t = self.model.apply_model(x, t, c, **kwargs)
                 e_t_uncond = self.model.apply_model(x, t, unconditional_conditioning, **kwargs)
             elif isinstance(c, dict):
@@ -254,43 +370,33 @@ class DDIMSampler(object):
         if score_corrector is not None:
             assert self.model.parameterization == "eps"
             e_t = score_corrector.modify_score(self.model, e_t, x, t, c, **corrector_kwargs)
+        return e_t
 
-        alphas = self.model.alphas_cumprod if use_original_steps else self.ddim_alphas
-        alphas_prev = self.model.alphas_cumprod_prev if use_original_steps else self.ddim_alphas_prev
-        sqrt_one_minus_alphas = self.model.sqrt_one_minus_alphas_cumprod if use_original_steps else self.ddim_sqrt_one_minus_alphas
-        sigmas = self.model.ddim_sigmas_for_original_num_steps if use_original_steps else self.ddim_sigmas
-        # select parameters corresponding to the currently considered timestep
-        
-        if is_video:
-            size = (b, 1, 1, 1, 1)
-        else:
-            size = (b, 1, 1, 1)
-        a_t = torch.full(size, alphas[index], device=device)
-        a_prev = torch.full(size, alphas_prev[index], device=device)
-        sigma_t = torch.full(size, sigmas[index], device=device)
-        sqrt_one_minus_at = torch.full(size, sqrt_one_minus_alphas[index],device=device)
-
-        # current prediction for x_0
-        pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
-        if quantize_denoised:
-            pred_x0, _, *_ = self.model.first_stage_model.quantize(pred_x0)
-        # direction pointing to x_t
-        dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t
-
-        noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
-        if noise_dropout > 0.:
-            noise = torch.nn.functional.dropout(noise, p=noise_dropout)
-        
-        alphas = self.model.alphas_cumprod if use_original_steps else self.ddim_alphas
-        if self.use_scale:
-            scale_arr = self.model.scale_arr if use_original_steps else self.ddim_scale_arr
-            scale_t = torch.full(size, scale_arr[index], device=device)
-            scale_arr_prev = self.model.scale_arr_prev if use_original_steps else self.ddim_scale_arr_prev
-            scale_t_prev = torch.full(size, scale_arr_prev[index], device=device)
-            pred_x0 /= scale_t 
-            x_prev = a_prev.sqrt() * scale_t_prev * pred_x0 + dir_xt + noise
-        else:
-            x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
+    @torch.no_grad()
+    def p_sample_ddim(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
+                      temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, guidance_interval=None, **kwargs):
+        """
+        unconditional_guidance_scale: a float, or one scale per sampling step.
+        guidance_interval: (start, end) sampling steps with guidance, see guidance_scale_at.
+        """
+        device = x.device
+        coefficient_table = self.original_coefficients if use_original_steps else self.ddim_coefficients
+        num_steps = coefficient_table.shape[0]
+        unconditional_guidance_scale = guidance_scale_at(unconditional_guidance_scale, num_steps - index - 1, num_steps,
+                                                         guidance_interval)
+        e_t = self.guided_model_output(x, c, t, unconditional_guidance_scale, unconditional_conditioning,
+                                       score_corrector=score_corrector, corrector_kwargs=corrector_kwargs, **kwargs)
+
+        # coefficients of the current step, as device scalars
+        coefficients = coefficient_table[index]
+        quantize = (lambda x0: self.model.first_stage_model.quantize(x0)[0]) if quantize_denoised else None
+        noise = None
+        if self.ddim_eta != 0.:
+            noise = noise_like(x.shape, device, repeat_noise) * temperature
+            if noise_dropout > 0.:
+                noise = torch.nn.functional.dropout(noise, p=noise_dropout)
+        x_prev, pred_x0 = ddim_update(x, e_t, coefficients, noise, quantize)
 
         return x_prev, pred_x0
 
@@ -0,0 +1,154 @@
+import numpy as np
+from tqdm import tqdm
+import torch
+from lvdm.models.samplers.ddim import DDIMSampler, guidance_scale_at
+from lvdm.common import context_cache
+
+
+## columns of the per-step coefficient table of the DPM-Solver++(2M) update
+DPM_SOLVER_COEFFICIENTS = ('recip_alpha', 'sigma', 'sigma_ratio', 'x0_coef', 'cur_weight', 'prev_weight')
+
+
+def dpm_solver_coefficients(alphas, alphas_prev, scale=None, scale_prev=None, lower_order_final=True):
+    """
+    Coefficient table (steps, k) of DPM-Solver++(2M) (https://arxiv.org/abs/2211.01095),
+    indexed like the DDIM tables: row i steps from alphas[i] to alphas_prev[i]. With the
+    latent rescaling (use_scale), the signal coefficient of x_t is sqrt(alpha_t) * scale_t.
+    The first step, and the last one for fewer than 15 steps, are first order.
+    """
+    scale = torch.ones_like(alphas) if scale is None else scale
+    scale_prev = torch.ones_like(alphas) if scale_prev is None else scale_prev
+    alphas, alphas_prev, scale, scale_prev = map(lambda a: a.double(), (alphas, alphas_prev, scale, scale_prev))
+    alpha_s, sigma_s = alphas.sqrt() * scale, (1. - alphas).sqrt()
+    alpha_t, sigma_t = alphas_prev.sqrt() * scale_prev, (1. - alphas_prev).sqrt()
+    ## step in log-SNR, and the step taken before it (row i + 1 runs before row i)
+    h = (alpha_t / sigma_t).log() - (alpha_s / sigma_s).log()
+    h_prev = torch.cat([h[1:], h[-1:]])
+    prev_weight = -0.5 * h / h_prev
+    cur_weight = 1. - prev_weight
+    first_order = torch.zeros_like(h, dtype=torch.bool)
+    first_order[-1] = True
+    if lower_order_final and h.shape[0] < 15:
+        first_order[0] = True
+    cur_weight[first_order], prev_weight[first_order] = 1., 0.
+    return torch.stack([1. / alpha_s, sigma_s, sigma_t / sigma_s, -alpha_t * torch.expm1(-h),
+                        cur_weight, prev_weight], dim=1).float()
+
+
+def dpm_solver_update(x, e_t, coefficients, x0_prev=None):
+    """
+    One DPM-Solver++(2M) step from x_s and the predicted noise e_t, given the coefficient
+    row of the step (k,) and the x_0 prediction of the previous step (None on the first).
+    Returns x_t, pred_x0.
+    """
+    recip_alpha, sigma, sigma_ratio, x0_coef, cur_weight, prev_weight = coefficients.unbind()
+    pred_x0 = torch.addcmul(x, e_t, sigma, value=-1.).mul_(recip_alpha)
+    if x0_prev is None:
+        d = pred_x0
+    else:
+        d = torch.addcmul(pred_x0 * cur_weight, x0_prev, prev_weight)
+    x_prev = torch.addcmul(x * sigma_ratio, d, x0_coef)
+    return x_prev, pred_x0
+
+
+class DPMSolverSampler(DDIMSampler):
+    """
+    Deterministic second-order multistep sampler (DPM-Solver++(2M)) on the DDIM
+    timesteps. A drop-in for DDIMSampler: same sample() signature, same guidance,
+    mask/x0 blending and FreePCA kwargs, at comparable quality in 15-25 steps.
+    eta, temperature and noise_dropout are accepted and ignored.
+    """
+    def build_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
+        schedule = super().build_schedule(ddim_num_steps, ddim_discretize, ddim_eta, verbose)
+        schedule['solver_coefficients'] = dpm_solver_coefficients(schedule['ddim_alphas'], schedule['ddim_alphas_prev'],
+                                                                  schedule.get('ddim_scale_arr'),
+                                                                  schedule.get('ddim_scale_arr_prev'))
+        return schedule
+
+    @torch.no_grad()
+    def sample(self,
+               S,
+               batch_size,
+               shape,
+               conditioning=None,
+               callback=None,
+               normals_sequence=None,
+               img_callback=None,
+               quantize_x0=False,
+               eta=0.,
+               mask=None,
+               x0=None,
+               temperature=1.,
+               noise_dropout=0.,
+               score_corrector=None,
+               corrector_kwargs=None,
+               verbose=True,
+               schedule_verbose=False,
+               x_T=None,
+               log_every_t=100,
+               unconditional_guidance_scale=1.,
+               unconditional_conditioning=None,
+               **kwargs
+               ):
+        ## the solver is deterministic: the schedule is the eta = 0 one whatever eta is
+        self.make_schedule(ddim_num_steps=S, ddim_eta=0., verbose=schedule_verbose)
+
+        if len(shape) == 3:
+            C, H, W = shape
+            size = (batch_size, C, H, W)
+        elif len(shape) == 4:
+            C, T, H, W = shape
+            size = (batch_size, C, T, H, W)
+
+        with context_cache(self.model):
+            samples, intermediates = self.dpm_solver_sampling(conditioning, size,
+                                                              callback=callback,
+                                                              img_callback=img_callback,
+                                                              mask=mask, x0=x0,
+                                                              score_corrector=score_corrector,
+                                                              corrector_kwargs=corrector_kwargs,
+                                                              x_T=x_T,
+                                                              log_every_t=log_every_t,
+                                                              unconditional_guidance_scale=unconditional_guidance_scale,
+                                                              unconditional_conditioning=unconditional_conditioning,
+                                                              verbose=verbose,
+                                                              **kwargs)
+        return samples, intermediates
+
+    @torch.no_grad()
+    def dpm_solver_sampling(self, cond, shape, x_T=None, callback=None, mask=None, x0=None, img_callback=None,
+                            log_every_t=100, unconditional_guidance_scale=1., unconditional_conditioning=None,
+                            verbose=True, guidance_interval=None, **kwargs):
+        device = self.model.betas.device
+        b = shape[0]
+        img = torch.randn(shape, device=device) if x_T is None else x_T
+
+        intermediates = {'x_inter': [img], 'pred_x0': [img]}
+        time_range = np.flip(self.ddim_timesteps)
+        total_steps = self.ddim_timesteps.shape[0]
+        iterator = tqdm(time_range, desc='DPM-Solver++ Sampler', total=total_steps) if verbose else time_range
+        clean_cond = kwargs.pop("clean_cond", False)
+
+        pred_x0 = None
+        for i, step in enumerate(iterator):
+            index = total_steps - i - 1
+            ts = torch.full((b,), step, device=device, dtype=torch.long)
+
+            # use mask to blend noised original latent (img_orig) & new sampled latent (img)
+            if mask is not None:
+                assert x0 is not None
+                img_orig = x0 if clean_cond else self.model.q_sample(x0, ts)
+                img = img_orig * mask + (1. - mask) * img
+
+            scale = guidance_scale_at(unconditional_guidance_scale, i, total_steps, guidance_interval)
+            e_t = self.guided_model_output(img, cond, ts, scale, unconditional_conditioning, x0=x0, **kwargs)
+            img, pred_x0 = dpm_solver_update(img, e_t, self.solver_coefficients[index], pred_x0)
+
+            if callback: callback(i)
+            if img_callback: img_callback(pred_x0, i)
+
+            if index % log_every_t == 0 or index == total_steps - 1:
+                intermediates['x_inter'].append(img)
+                intermediates['pred_x0'].append(pred_x0)
+
+        return img, intermediates
@@ -8,12 +8,6 @@ import scipy.io as io
 import numpy as np
 import pickle
 
-try:
-    import xformers
-    import xformers.ops
-    XFORMERS_IS_AVAILBLE = True
-except:
-    XFORMERS_IS_AVAILBLE = False
 from lvdm.common import (
     checkpoint,
     exists,
@@ -22,9 +16,22 @@ from lvdm.common import (
 from lvdm.basics import (
     zero_module,
 )
+from lvdm.modules.attention_backends import (
+    available_backends,
+    run_attention,
+)
+from lvdm.modules.freepca import (
+    get_view_plan,
+    gather_views,
+    freepca_fuse,
+    fusion_statistics,
+    fusion_operator,
+    apply_fusion,
+    EigenbasisCache,
+    FreePCAPolicy,
+    FUSION_BASES,
+)
 
-def generate_weight_sequence():
-    return [1]*16 # weight_sequence
 
 class RelativePosition(nn.Module):
     """ https://github.com/evelinehong/Transformer_Relative_Position_PyTorch/blob/master/relative_position.py """
@@ -36,22 +43,49 @@ class RelativePosition(nn.Module):
         self.embeddings_table = nn.Parameter(torch.Tensor(max_relative_position * 2 + 1, num_units))
         nn.init.xavier_uniform_(self.embeddings_table)
 
-    def forward(self, length_q, length_k):
+        ## gathered (length_q, length_k, num_units) tables, reused while the table is unchanged and no grad is needed
+        self._index = {}
+        self._embeddings = {}
+
+    def forward(self, length_q, length_k, stride_k=1):
+        ## keys sit at every stride_k-th frame
         device = self.embeddings_table.device
-        range_vec_q = torch.arange(length_q, device=device)
-        range_vec_k = torch.arange(length_k, device=device)
-        distance_mat = range_vec_k[None, :] - range_vec_q[:, None]
-        distance_mat_clipped = torch.clamp(distance_mat, -self.max_relative_position, self.max_relative_position)
-        final_mat = distance_mat_clipped + self.max_relative_position
-        final_mat = final_mat.long()
-        embeddings = self.embeddings_table[final_mat]
-        return embeddings
+        key = (length_q, length_k, stride_k, device)
+        if key not in self._index:
+            range_vec_q = torch.arange(length_q, device=device)
+            range_vec_k = torch.arange(length_k, device=device) * stride_k
+            distance_mat = range_vec_k[None, :] - range_vec_q[:, None]
+            distance_mat_clipped = torch.clamp(distance_mat, -self.max_relative_position, self.max_relative_position)
+            final_mat = distance_mat_clipped + self.max_relative_position
+            self._index[key] = final_mat.long()
+        if torch.is_grad_enabled() and self.embeddings_table.requires_grad:
+            return self.embeddings_table[self._index[key]]
+        ## the table version moves on every in-place update (optimizer step, load_state_dict, .to())
+        version = (self.embeddings_table._version, self.embeddings_table.dtype)
+        if key not in self._embeddings or self._embeddings[key][0] != version:
+            self._embeddings[key] = (version, self.embeddings_table[self._index[key]])
+        return self._embeddings[key][1]
+
+
+def masked_fill_heads_(sim, mask, h):
+    """
+    Mask the attention logits sim ((b h), ..., i, j) in place. mask (b or 1, ..., i, j) is
+    broadcast over the heads (and over b when its leading dim is 1) instead of repeated.
+    """
+    ## feasible for causal attention mask only
+    max_neg_value = -torch.finfo(sim.dtype).max
+    sim.view(-1, h, *sim.shape[1:]).masked_fill_(~(mask > 0.5)[:, None], max_neg_value)
+    return sim
 
 
 class CrossAttention(nn.Module):
 
     def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0., 
-                 relative_position=False, temporal_length=None, img_cross_attention=False, injection=False):
+                 relative_position=False, temporal_length=None, img_cross_attention=False, injection=False,
+                 window_size=None, window_stride=4, batched_windows=True, eigenbasis_reuse=0, eigenbasis_drift=None,
+                 chunk_size=None, temporal_backend=None, blend_kernel='uniform',
+                 fuse_timestep=250, max_components=3, fuse_layers=None, long_layers=None, fusion_basis='eigen',
+                 keyframe_stride=1):
         super().__init__()
         inner_dim = dim_head * heads
         context_dim = default(context_dim, query_dim)
@@ -78,31 +112,56 @@ class CrossAttention(nn.Module):
             self.relative_position_v = RelativePosition(num_units=dim_head, max_relative_position=temporal_length)
         else:
             ## only used for spatial attention, while NOT for temporal attention
-            if XFORMERS_IS_AVAILBLE and temporal_length is None:
-                self.forward = self.efficient_forward
+            if temporal_length is None:
+                self.forward = self.spatial_forward
 
         self.injection = injection
-
+        ## set to a ContextCache for the length of a sampling run, see lvdm.common.context_cache
+        self.context_cache = None
+        ## independent groups the batch splits into (e.g. a fused CFG pass), see lvdm.common.batch_groups
+        self.batch_groups = 1
+        ## short-window views, planned from the actual number of frames
+        self.temporal_length = default(temporal_length, 16)
+        self.window_size = default(window_size, self.temporal_length)
+        self.window_stride = window_stride
+        self.blend_kernel = blend_kernel
+        ## run all short windows as one batched attention instead of a per-window loop
+        self.batched_windows = batched_windows
+        ## reuse FreePCA eigenbases for up to `eigenbasis_reuse` steps (0 recomputes them every step)
+        self.eigenbasis_cache = EigenbasisCache(eigenbasis_reuse, eigenbasis_drift) if eigenbasis_reuse > 0 else None
+        ## stream temporal attention over chunks of this many (b h w) locations to bound peak memory
+        self.chunk_size = chunk_size
+        ## which of long-frame branch, FreePCA fusion and short windows run, per layer and timestep
+        self.policy = FreePCAPolicy(fuse_timestep, max_components, fuse_layers, long_layers)
+        ## 'eigen' fuses in the exact PCA basis of every window, 'dct' in a fixed DCT-II basis
+        if fusion_basis not in FUSION_BASES:
+            raise ValueError(f"fusion basis '{fusion_basis}' unknown, choose from {list(FUSION_BASES)}")
+        self.fusion_basis = fusion_basis
+        ## long-frame keys/values from every `keyframe_stride`-th frame only: O(T * T/k) instead of O(T^2)
+        self.keyframe_stride = keyframe_stride
+        ## attention backend of both temporal branches (see ATTENTION_BACKENDS); None follows the temporal roles
+        if temporal_backend is not None and temporal_backend != 'auto' and temporal_backend not in available_backends():
+            raise ValueError(f"attention backend '{temporal_backend}' unavailable, choose from {available_backends() + ['auto']}")
+        self.temporal_backend = temporal_backend
 
 
     def forward(self, x, context=None, mask=None, context_next=None, use_injection=False, timesteps=None, num_layer=None):
 
-        def get_views(video_length, window_size=16, stride=4):
-            num_blocks_time = (video_length - window_size) // stride + 1
-            views = []
-            for i in range(num_blocks_time):
-                t_start = int(i * stride)
-                t_end = t_start + window_size
-                views.append((t_start,t_end))
-            return views
-
-        context_next = get_views(64, 16, 4)
+        view_plan = get_view_plan(x.shape[1], self.window_size, self.window_stride, self.temporal_length, self.blend_kernel)
+        context_next = view_plan.views
 
         sa_flag = False
         if context is None:
             sa_flag = True
 
         # context is always None
+        if sa_flag:
+            ## timesteps is read on the host once per UNet call, see UNetModel.forward
+            mode = self.policy.mode(num_layer, timesteps)
+            if self.eigenbasis_cache is not None:
+                self.eigenbasis_cache.update(timesteps)
+        if sa_flag and exists(self.chunk_size) and x.shape[0] > self.chunk_size and not self.img_cross_attention:
+            return self._chunked_forward(x, view_plan, mask, mode)
 
         h = self.heads
         
@@ -120,43 +179,19 @@ class CrossAttention(nn.Module):
             all_k = self.to_k(context)
             all_v = self.to_v(context)
 
-        count = torch.zeros_like(all_k) ####
-        value = torch.zeros_like(all_k)
-
         if (sa_flag) and (context_next is not None):
             all_q, all_k, all_v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (all_q, all_k, all_v))
             if context is not None and self.img_cross_attention:
                 all_k_ip, all_v_ip = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (all_k_ip, all_v_ip))
             
             # ------------------------long frame------------------------
-
-            qk_scale0 = (math.log(64, 16)) ** 0.5 # attention entropy
-
-            all_sim = torch.einsum('b i d, b j d -> b i j',  qk_scale0* all_q, all_k) * self.scale
-            if self.relative_position:
-                all_len_q, all_len_k, all_len_v = all_.shape[1], all_k.shape[1], all_v.shape[1]
-                all_k2 = self.relative_position_k(len_q, len_k)
-                all_sim2 = einsum('b t d, t s d -> b t s', all_q, all_k2) * self.scale # TODO check 
-                all_sim += all_sim2
-            # del all_k
-
-            if exists(mask):
-                ## feasible for causal attention mask only
-                max_neg_value = -torch.finfo(all_sim.dtype).max
-                mask = repeat(mask, 'b i j -> (b h) i j', h=h)
-                sim.masked_fill_(~(mask>0.5), max_neg_value)
-
-            # attention, what we cannot get enough of
-            all_sim = all_sim.softmax(dim=-1)
-            all_out = torch.einsum('b i j, b j d -> b i d', all_sim, all_v)
-            if self.relative_position:
-                all_v2 = self.relative_position_v(all_len_q, all_len_v)
-                all_out2 = einsum('b t s, t s d -> b t d', all_sim, all_v2) # TODO check
-                all_out += all_out2
-            all_out = rearrange(all_out, '(b h) n d -> b n (h d)', h=h)
+            if mode != 'short':
+                all_out = self._long_frame_attention(all_q, all_k, all_v, view_plan.entropy_scale, mask)
+            else:
+                all_out = None
 
             ## considering image token additionally
-            if context is not None and self.img_cross_attention:
+            if all_out is not None and context is not None and self.img_cross_attention:
                 all_k_ip, all_v_ip = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (all_k_ip, all_v_ip))
                 all_sim_ip =  torch.einsum('b i d, b j d -> b i j', all_q, all_k_ip) * self.scale
                 del all_k_ip
@@ -167,102 +202,71 @@ class CrossAttention(nn.Module):
             # del all_q
 
             # ------------------------short frame------------------------
-            preserve = 0
-            tobeprint_list = []
-            for t_start, t_end in context_next:
-                weight_sequence = generate_weight_sequence()
-                weight_tensor = torch.ones_like(count[:, t_start:t_end])
-                weight_tensor = weight_tensor * torch.Tensor(weight_sequence).to(x.device).unsqueeze(0).unsqueeze(-1)
-
-                q = all_q[:, t_start:t_end]
-                k = all_k[:, t_start:t_end]
-                v = all_v[:, t_start:t_end] ###### clip the video frame
-
-                sim = torch.einsum('b i d, b j d -> b i j', q, k) * self.scale
-                if self.relative_position:
-                    len_q, len_k, len_v = q.shape[1], k.shape[1], v.shape[1]
-                    k2 = self.relative_position_k(len_q, len_k)
-                    sim2 = einsum('b t d, t s d -> b t s', q, k2) * self.scale # TODO check 
-                    sim += sim2
-                del k
-
-                if exists(mask):
-                    ## feasible for causal attention mask only
-                    max_neg_value = -torch.finfo(sim.dtype).max
-                    mask = repeat(mask, 'b i j -> (b h) i j', h=h)
-                    sim.masked_fill_(~(mask>0.5), max_neg_value)
-
-                # attention, what we cannot get enough of
-                sim = sim.softmax(dim=-1)
-                out = torch.einsum('b i j, b j d -> b i d', sim, v)
-                if self.relative_position:
-                    v2 = self.relative_position_v(len_q, len_v)
-                    out2 = einsum('b t s, t s d -> b t d', sim, v2) # TODO check
-                    out += out2
-                out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
-                # print('out is', out.shape) # dim=1 is frame
-
-                ## considering image token additionally
-                if context is not None and self.img_cross_attention:
-                    k_ip = all_k_ip[:, t_start:t_end] #
-                    v_ip = all_v_ip[:, t_start:t_end] #
-                    sim_ip =  torch.einsum('b i d, b j d -> b i j', q, k_ip) * self.scale
-                    del k_ip
-                    sim_ip = sim_ip.softmax(dim=-1)
-                    out_ip = torch.einsum('b i j, b j d -> b i d', sim_ip, v_ip)
-                    out_ip = rearrange(out_ip, '(b h) n d -> b n (h d)', h=h)
-                    out = out + self.image_cross_attention_scale * out_ip
-                del q
-
-                # --------------------FreePCA begin-------------------
-                if (preserve > 0 and timesteps > 250) or (preserve > 3 and timesteps > 500):
-                    
-                    dim_d = out.shape[-1]
-                    ref_out = rearrange(out, 'b n d -> (b d) n', d=dim_d)
+            if mode == 'long':
+                final_out = all_out
+            elif self.batched_windows:
+                all_k_ip, all_v_ip = (all_k_ip, all_v_ip) if self.img_cross_attention else (None, None)
+                final_out = self._batched_window_forward(all_q, all_k, all_v, all_out, view_plan, mask, mode,
+                                                         all_k_ip=all_k_ip, all_v_ip=all_v_ip)
+            else:
+                ## blend weights already carry the overlap normalisation
+                blend_weights = view_plan.blend_weights(x.device, all_q.dtype)
+                value = all_q.new_zeros(x.shape[0], x.shape[1], h * self.dim_head)
+                fused_k = dict(zip(*self._fused_windows(view_plan, mode)))
+                preserve = 0
+                for t_start, t_end in context_next:
+                    weight_tensor = blend_weights[preserve][None, :, None]
+
+                    q = all_q[:, t_start:t_end]
+                    k = all_k[:, t_start:t_end]
+                    v = all_v[:, t_start:t_end] ###### clip the video frame
+
+                    sim = torch.einsum('b i d, b j d -> b i j', q, k) * self.scale
+                    if self.relative_position:
+                        len_q, len_k, len_v = q.shape[1], k.shape[1], v.shape[1]
+                        k2 = self.relative_position_k(len_q, len_k)
+                        sim2 = einsum('b t d, t s d -> b t s', q, k2) * self.scale # TODO check 
+                        sim += sim2
+                    del k
+
+                    if exists(mask):
+                        masked_fill_heads_(sim, mask[:, t_start:t_end, t_start:t_end], h)
+
+                    # attention, what we cannot get enough of
+                    sim = sim.softmax(dim=-1)
+                    out = torch.einsum('b i j, b j d -> b i d', sim, v)
+                    if self.relative_position:
+                        v2 = self.relative_position_v(len_q, len_v)
+                        out2 = einsum('b t s, t s d -> b t d', sim, v2) # TODO check
+                        out += out2
+                    out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
+                    # print('out is', out.shape) # dim=1 is frame
+
+                    ## considering image token additionally
+                    if context is not None and self.img_cross_attention:
+                        k_ip = all_k_ip[:, t_start:t_end] #
+                        v_ip = all_v_ip[:, t_start:t_end] #
+                        sim_ip =  torch.einsum('b i d, b j d -> b i j', q, k_ip) * self.scale
+                        del k_ip
+                        sim_ip = sim_ip.softmax(dim=-1)
+                        out_ip = torch.einsum('b i j, b j d -> b i d', sim_ip, v_ip)
+                        out_ip = rearrange(out_ip, '(b h) n d -> b n (h d)', h=h)
+                        out = out + self.image_cross_attention_scale * out_ip
+                    del q
+
+                    # --------------------FreePCA begin-------------------
+                    if preserve in fused_k:
+                        # Progressive Fusion
+                        selected_k = fused_k[preserve]
+                        out = freepca_fuse(out[:, None], all_out[:, None, t_start:t_end, :], [selected_k],
+                                           basis_cache=self.eigenbasis_cache, key=(self.batch_groups, t_start, t_end),
+                                           basis=self.fusion_basis, groups=self.batch_groups)[:, 0]
+                    #---------------------FreePCA end---------------------
+                    preserve += 1
                     
-                    com_out = all_out[:, t_start:t_end, :] # clip the long frames to short frames
-                    com_out = rearrange(com_out, 'b n d -> (b d) n', d=dim_d)
-                    # Consistency Feature Decomposition
-                    ref_mean = torch.mean(ref_out, dim=-1, keepdim=True)
-                    ref_data = ref_out - ref_mean
-
-                    comp_mean = torch.mean(com_out, dim=-1, keepdim=True)
-                    comp_data = com_out - comp_mean
-
-                    cov_matrix = torch.matmul(comp_data.t(), comp_data) / (ref_out.size(1) - 1)
-                    eigenvalues, eigenvectors = torch.linalg.eig(cov_matrix)
-
-                    # sorted_indices = torch.argsort(eigenvalues.real, descending=True)
-
-                    origin_pca = torch.matmul(ref_data, eigenvectors.real)
-                    comp_pca = torch.matmul(comp_data, eigenvectors.real)
-
-                    cos_similarities = []
-                    for i in range(origin_pca.size(1)):
-                        cos_similarity = F.cosine_similarity(origin_pca[:, i], comp_pca[:, i], dim=0)
-                        cos_similarities.append(cos_similarity.item())
-
-                    cos_similarities = torch.tensor(cos_similarities)
-
-                    sorted_indices = torch.argsort(cos_similarities, descending=True)
-                    # Progressive Fusion
-                    selected_k = min(preserve, 3)  
+                    value[:,t_start:t_end] += out * weight_tensor #
 
-                    comp_pca[:, sorted_indices[selected_k:]] = 0
-                    origin_pca[:, sorted_indices[:selected_k]] = 0
-
-                    fuse_pca = origin_pca + comp_pca
-
-                    out = torch.matmul(fuse_pca, eigenvectors.t().real) + comp_mean 
-
-                    out = rearrange(out, '(b d) n -> b n d', d=dim_d)
-                #---------------------FreePCA end---------------------
-                preserve += 1
-                
-                value[:,t_start:t_end] += out * weight_tensor #
-                count[:,t_start:t_end] += weight_tensor #
-
-            final_out = torch.where(count>0, value/count, value) # (?, frame, ?)
+                final_out = value # (?, frame, ?)
 
         else:
             # print('cross atten')
@@ -276,10 +280,7 @@ class CrossAttention(nn.Module):
             del k
 
             if exists(mask):
-                ## feasible for causal attention mask only
-                max_neg_value = -torch.finfo(sim.dtype).max
-                mask = repeat(mask, 'b i j -> (b h) i j', h=h)
-                sim.masked_fill_(~(mask>0.5), max_neg_value)
+                masked_fill_heads_(sim, mask, h)
 
             # attention, what we cannot get enough of
             sim = sim.softmax(dim=-1)
@@ -304,74 +305,237 @@ class CrossAttention(nn.Module):
 
         return self.to_out(final_out)
     
-    # spatial attention
-    def efficient_forward(self, x, context=None, mask=None, context_next=None, use_injection=False, timesteps=None, num_layer=None):
-        sa_flag = False
-        if context is None:
-            sa_flag = True
+    def _long_frame_attention(self, all_q, all_k, all_v, qk_scale0, mask=None):
+        """
+        Attention over all frames, sharpened by the attention-entropy scale qk_scale0.
+        all_q, all_k, all_v: (b h) n d. Returns b n (h d).
+        With keyframe_stride > 1 every frame attends to the keyframes only, and the entropy
+        scale follows the number of keys attended.
+        """
+        h = self.heads
+        if self.keyframe_stride > 1:
+            all_k, all_v = all_k[:, ::self.keyframe_stride], all_v[:, ::self.keyframe_stride]
+            mask = mask[..., ::self.keyframe_stride] if exists(mask) else None
+            qk_scale0 = max(math.log(all_k.shape[1], self.temporal_length), 1.) ** 0.5
+        if not self.relative_position:
+            ## entropy scale folded into the query, the backends apply dim_head**-0.5 themselves
+            q, k, v = map(lambda t: rearrange(t, '(b h) n d -> b h n d', h=h), (qk_scale0 * all_q, all_k, all_v))
+            attn_mask = (mask > 0.5)[:, None] if exists(mask) else None
+            all_out = run_attention('temporal_long', q, k, v, attn_mask, backend=self.temporal_backend)
+            return rearrange(all_out, 'b h n d -> b n (h d)')
+
+        all_sim = torch.einsum('b i d, b j d -> b i j',  qk_scale0* all_q, all_k) * self.scale
+        if self.relative_position:
+            all_len_q, all_len_k, all_len_v = all_q.shape[1], all_k.shape[1], all_v.shape[1]
+            all_k2 = self.relative_position_k(all_len_q, all_len_k, self.keyframe_stride)
+            all_sim2 = einsum('b t d, t s d -> b t s', all_q, all_k2) * self.scale
+            all_sim += all_sim2
+        # del all_k
 
-        q = self.to_q(x)
-        context = default(context, x)
+        if exists(mask):
+            masked_fill_heads_(all_sim, mask, h)
 
-        if not sa_flag: 
-            sq_size = x.shape[0]
-            if self.injection and use_injection:
-                context_new = context[-sq_size:]
-            else:
-                context_new = context[:sq_size]
-        else:
-            context_new = context.clone()
+        # attention, what we cannot get enough of
+        all_sim = all_sim.softmax(dim=-1)
+        all_out = torch.einsum('b i j, b j d -> b i d', all_sim, all_v)
+        if self.relative_position:
+            all_v2 = self.relative_position_v(all_len_q, all_len_v, self.keyframe_stride)
+            all_out2 = einsum('b t s, t s d -> b t d', all_sim, all_v2)
+            all_out += all_out2
+        return rearrange(all_out, '(b h) n d -> b n (h d)', h=h)
+
+    def _window_attention(self, all_q, all_k, all_v, view_plan, mask=None, all_k_ip=None, all_v_ip=None):
+        """
+        Short-window attention over all views at once.
+        all_q, all_k, all_v: (b h) n d. Returns the output of every view, b w n (h d).
+        """
+        h = self.heads
+        views = view_plan.views
+        q, k, v = map(lambda t: gather_views(t, views), (all_q, all_k, all_v))
+        if exists(mask):
+            index = view_plan.index(all_q.device)
+            mask = mask[:, index[:, :, None], index[:, None, :]]
+        if not self.relative_position and all_k_ip is None:
+            ## views folded into the batch: the fused SDPA kernels only take 4-D q, k, v
+            b = q.shape[0] // h
+            q, k, v = map(lambda t: rearrange(t, '(b h) w n d -> (b w) h n d', h=h), (q, k, v))
+            ## mask (b or 1, w, n, n) -> ((b w), 1, n, n); every view has its own mask
+            attn_mask = (mask > 0.5).expand(b, -1, -1, -1).flatten(0, 1)[:, None] if exists(mask) else None
+            out = run_attention('temporal_window', q, k, v, attn_mask, backend=self.temporal_backend)
+            return rearrange(out, '(b w) h n d -> b w n (h d)', b=b)
+
+        sim = torch.einsum('b w i d, b w j d -> b w i j', q, k) * self.scale
+        if self.relative_position:
+            len_q, len_k, len_v = q.shape[2], k.shape[2], v.shape[2]
+            k2 = self.relative_position_k(len_q, len_k)
+            sim2 = einsum('b w t d, t s d -> b w t s', q, k2) * self.scale
+            sim += sim2
+        del k
 
-        ## considering image token additionally
-        if context is not None and self.img_cross_attention:
-            context, context_img = context_new[:,:self.text_context_len,:], context_new[:,self.text_context_len:,:]
-            k = self.to_k(context)
-            v = self.to_v(context)
-            k_ip = self.to_k_ip(context_img)
-            v_ip = self.to_v_ip(context_img)
-        else:
-            k = self.to_k(context_new)
-            v = self.to_v(context_new)
-
-        b, _, _ = q.shape
-        q, k, v = map(
-            lambda t: t.unsqueeze(3)
-            .reshape(b, t.shape[1], self.heads, self.dim_head)
-            .permute(0, 2, 1, 3)
-            .reshape(b * self.heads, t.shape[1], self.dim_head)
-            .contiguous(),
-            (q, k, v),
-        )
-        # actually compute the attention, what we cannot get enough of
-        out = xformers.ops.memory_efficient_attention(q, k, v, attn_bias=None, op=None)
+        if exists(mask):
+            masked_fill_heads_(sim, mask, h)
+
+        # attention, what we cannot get enough of
+        sim = sim.softmax(dim=-1)
+        out = torch.einsum('b w i j, b w j d -> b w i d', sim, v)
+        if self.relative_position:
+            v2 = self.relative_position_v(len_q, len_v)
+            out2 = einsum('b w t s, t s d -> b w t d', sim, v2)
+            out += out2
+        out = rearrange(out, '(b h) w n d -> b w n (h d)', h=h)
 
         ## considering image token additionally
-        if context is not None and self.img_cross_attention:
-            k_ip, v_ip = map(
-                lambda t: t.unsqueeze(3)
-                .reshape(b, t.shape[1], self.heads, self.dim_head)
-                .permute(0, 2, 1, 3)
-                .reshape(b * self.heads, t.shape[1], self.dim_head)
-                .contiguous(),
-                (k_ip, v_ip),
-            )
-            out_ip = xformers.ops.memory_efficient_attention(q, k_ip, v_ip, attn_bias=None, op=None)
-            out_ip = (
-                out_ip.unsqueeze(0)
-                .reshape(b, self.heads, out.shape[1], self.dim_head)
-                .permute(0, 2, 1, 3)
-                .reshape(b, out.shape[1], self.heads * self.dim_head)
-            )
+        if all_k_ip is not None:
+            k_ip, v_ip = map(lambda t: gather_views(t, views), (all_k_ip, all_v_ip))
+            sim_ip = torch.einsum('b w i d, b w j d -> b w i j', q, k_ip) * self.scale
+            del k_ip
+            sim_ip = sim_ip.softmax(dim=-1)
+            out_ip = torch.einsum('b w i j, b w j d -> b w i d', sim_ip, v_ip)
+            out_ip = rearrange(out_ip, '(b h) w n d -> b w n (h d)', h=h)
+            out = out + self.image_cross_attention_scale * out_ip
+        return out
+
+    def _fused_windows(self, view_plan, mode):
+        ## views that take part in the FreePCA fusion, and the long-frame components each one keeps
+        if mode != 'fuse':
+            return [], []
+        selected_k = self.policy.selected_k(len(view_plan.views))
+        fused = [preserve for preserve, k in enumerate(selected_k) if k > 0]
+        return fused, [selected_k[preserve] for preserve in fused]
+
+    def _blend_windows(self, out, view_plan):
+        ## weight every view in place and scatter-add it back onto its frames in one op: b w n d -> b n d
+        ## the weights of each frame already sum to one, so no count buffer or division is needed
+        index = view_plan.index(out.device).flatten()
+        out.mul_(view_plan.blend_weights(out.device, out.dtype)[None, :, :, None])
+        value = out.new_zeros(out.shape[0], view_plan.video_length, out.shape[-1])
+        return value.index_add_(1, index, out.flatten(1, 2)) # (?, frame, ?)
+
+    def _batched_window_forward(self, all_q, all_k, all_v, all_out, view_plan, mask=None, mode='fuse',
+                                all_k_ip=None, all_v_ip=None):
+        """
+        Short-window attention over all views at once.
+        all_q, all_k, all_v: (b h) n d; all_out: long-frame output, b n (h d).
+        Returns the overlap-averaged window outputs, b n (h d).
+        """
+        out = self._window_attention(all_q, all_k, all_v, view_plan, mask, all_k_ip=all_k_ip, all_v_ip=all_v_ip)
+
+        # --------------------FreePCA begin-------------------
+        ## all qualifying windows of the layer go through one batched decomposition
+        fused, selected_k = self._fused_windows(view_plan, mode)
+        if len(fused) > 0:
+            # Progressive Fusion
+            fused_views = [view_plan.views[preserve] for preserve in fused]
+            com_out = gather_views(all_out, fused_views)
+            out[:, fused] = freepca_fuse(out[:, fused], com_out, selected_k,
+                                         basis_cache=self.eigenbasis_cache, key=(self.batch_groups, tuple(fused_views)),
+                                         basis=self.fusion_basis, groups=self.batch_groups)
+        #---------------------FreePCA end---------------------
+
+        return self._blend_windows(out, view_plan)
+
+    def _chunked_forward(self, x, view_plan, mask=None, mode='fuse'):
+        """
+        Temporal self-attention streamed over chunks of `chunk_size` (b h w) locations.
+        FreePCA needs statistics of the whole latent grid, so the long-frame outputs are
+        kept and the short windows run twice: once to gather the statistics, once to fuse.
+        Every batch group gathers its own statistics.
+        """
+        groups = self.batch_groups
+        if groups > 1:
+            mask_groups = mask.chunk(groups) if exists(mask) and mask.shape[0] > 1 else [mask] * groups
+            return torch.cat([self._chunked_group_forward(x_g, view_plan, mask_g, mode, key=(groups, g))
+                              for g, (x_g, mask_g) in enumerate(zip(x.chunk(groups), mask_groups))])
+        return self._chunked_group_forward(x, view_plan, mask, mode)
+
+    def _chunked_group_forward(self, x, view_plan, mask=None, mode='fuse', key=(1, 0)):
+        ## chunked temporal self-attention of one batch group; key tells the groups apart in the eigenbasis cache
+        h = self.heads
+        x_chunks = x.split(self.chunk_size)
+        ## a mask broadcast over all locations is shared by every chunk
+        mask_chunks = mask.split(self.chunk_size) if exists(mask) and mask.shape[0] > 1 else [mask] * len(x_chunks)
+        fused, selected_k = self._fused_windows(view_plan, mode)
+        fused_views = [view_plan.views[preserve] for preserve in fused]
+
+        def project(x_c):
+            q, k, v = self.to_q(x_c), self.to_k(x_c), self.to_v(x_c)
+            return map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (q, k, v))
+
+        ## pass 1: long-frame attention and the FreePCA statistics of the whole grid
+        all_outs, stats = [], 0.
+        if len(fused) > 0:
+            for x_c, mask_c in zip(x_chunks, mask_chunks):
+                q, k, v = project(x_c)
+                all_out = self._long_frame_attention(q, k, v, view_plan.entropy_scale, mask_c)
+                out = self._window_attention(q, k, v, view_plan, mask_c)
+                stats = stats + fusion_statistics(out[:, fused], gather_views(all_out, fused_views))
+                all_outs.append(all_out)
+            operator = fusion_operator(stats, selected_k, basis_cache=self.eigenbasis_cache, key=key + (tuple(fused_views),),
+                                       basis=self.fusion_basis)
+
+        ## pass 2: short windows again, fused and blended chunk by chunk
+        final_out = []
+        for i, (x_c, mask_c) in enumerate(zip(x_chunks, mask_chunks)):
+            q, k, v = project(x_c)
+            if mode == 'long':
+                final_out.append(self.to_out(self._long_frame_attention(q, k, v, view_plan.entropy_scale, mask_c)))
+                continue
+            out = self._window_attention(q, k, v, view_plan, mask_c)
+            if len(fused) > 0:
+                out[:, fused] = apply_fusion(out[:, fused], gather_views(all_outs[i], fused_views), operator)
+                all_outs[i] = None
+            final_out.append(self.to_out(self._blend_windows(out, view_plan)))
+        return torch.cat(final_out)
 
+    # spatial attention
+    def _spatial_qkv(self, x, context=None, use_injection=False):
+        ## projections of the spatial attention: q, k, v and, with image tokens, k_ip, v_ip (None otherwise); b n (h d)
+        q = self.to_q(x)
+        if context is None:
+            return (q,) + self._context_kv(x)
+
+        sq_size = x.shape[0]
+        if self.injection and use_injection:
+            context_new = context[-sq_size:]
+        else:
+            context_new = context[:sq_size]
+        if self.context_cache is None:
+            return (q,) + self._context_kv(context_new)
+        ## the text context is fixed over a sampling run: its keys/values are projected once per layer
+        key = (sq_size, self.injection and use_injection)
+        return (q,) + self.context_cache.get(context, key, lambda: self._context_kv(context_new))
+
+    def _context_kv(self, context):
+        ## considering image token additionally
+        if self.img_cross_attention:
+            context, context_img = context[:,:self.text_context_len,:], context[:,self.text_context_len:,:]
+            return self.to_k(context), self.to_v(context), self.to_k_ip(context_img), self.to_v_ip(context_img)
+        return self.to_k(context), self.to_v(context), None, None
+
+    def spatial_forward(self, x, context=None, mask=None, context_next=None, use_injection=False, timesteps=None, num_layer=None):
+        """
+        Spatial attention through the backend of its role (see run_attention): by default
+        xformers, else the fused SDPA kernel on GPU, else query-chunked math on CPU, where
+        SDPA still builds the full (hw x hw) similarity matrix.
+        """
         if exists(mask):
             raise NotImplementedError
-        out = (
-            out.unsqueeze(0)
-            .reshape(b, self.heads, out.shape[1], self.dim_head)
-            .permute(0, 2, 1, 3)
-            .reshape(b, out.shape[1], self.heads * self.dim_head)
-        )
-        if context is not None and self.img_cross_attention:
+        h = self.heads
+        role = 'spatial_self' if context is None else 'spatial_cross'
+        q, k, v, k_ip, v_ip = self._spatial_qkv(x, context, use_injection)
+
+        ## a context of one entry per video serves all frames of that video, (b t) n: the
+        ## queries of the t frames attend to it together, so keys/values are never repeated
+        assert q.shape[0] % k.shape[0] == 0, f"{q.shape[0]} frames do not split into {k.shape[0]} contexts"
+        frames = q.shape[0] // k.shape[0]
+        q = rearrange(q, '(b t) n (h d) -> b h (t n) d', h=h, t=frames)
+        k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h=h), (k, v))
+        out = rearrange(run_attention(role, q, k, v), 'b h (t n) d -> (b t) n (h d)', t=frames)
+
+        ## considering image token additionally
+        if k_ip is not None:
+            k_ip, v_ip = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h=h), (k_ip, v_ip))
+            out_ip = rearrange(run_attention('spatial_cross', q, k_ip, v_ip), 'b h (t n) d -> (b t) n (h d)', t=frames)
             out = out + self.image_cross_attention_scale * out_ip
         return self.to_out(out)
 
@@ -400,7 +564,8 @@ class BasicTransformerBlock(nn.Module):
         if context is not None:
             input_tuple = (x, context)
         if mask is not None:
-            forward_mask = partial(self._forward, mask=mask)
+            forward_mask = partial(self._forward, mask=mask, context_next=context_next, use_injection=use_injection,
+                                   timesteps=timesteps, num_layer=num_layer)
             return checkpoint(forward_mask, (x,), self.parameters(), self.checkpoint)
         if context is not None and mask is not None:
             input_tuple = (x, context, mask)
@@ -482,7 +647,7 @@ class TemporalTransformer(nn.Module):
     """
     def __init__(self, in_channels, n_heads, d_head, depth=1, dropout=0., context_dim=None,
                  use_checkpoint=True, use_linear=False, only_self_att=True, causal_attention=False,
-                 relative_position=False, temporal_length=None, injection=False):
+                 relative_position=False, temporal_length=None, injection=False, freepca_config=None):
         super().__init__()
         self.only_self_att = only_self_att
         self.relative_position = relative_position
@@ -496,14 +661,15 @@ class TemporalTransformer(nn.Module):
         else:
             self.proj_in = nn.Linear(in_channels, inner_dim)
 
+        ## FreePCA options (window_size, window_stride, ...) are passed on to every temporal CrossAttention
+        freepca_config = default(freepca_config, dict())
         if relative_position:
             assert(temporal_length is not None)
-            attention_cls = partial(CrossAttention, relative_position=True, temporal_length=temporal_length)
+            attention_cls = partial(CrossAttention, relative_position=True, temporal_length=temporal_length, **freepca_config)
         else:
-            attention_cls = partial(CrossAttention, temporal_length=temporal_length)
+            attention_cls = partial(CrossAttention, temporal_length=temporal_length, **freepca_config)
         if self.causal_attention:
             assert(temporal_length is not None)
-            self.mask = torch.tril(torch.ones([1, temporal_length, temporal_length]))
 
         if self.only_self_att:
             context_dim = None
@@ -536,8 +702,8 @@ class TemporalTransformer(nn.Module):
             x = self.proj_in(x)
 
         if self.causal_attention:
-            mask = self.mask.to(x.device)
-            mask = repeat(mask, 'l i j -> (l bhw) i j', bhw=b*h*w)
+            ## (1, t, t), broadcast over all (b h w) locations and heads by the attention
+            mask = torch.ones([1, t, t], device=x.device).tril()
         else:
             mask = None
 
@@ -548,7 +714,8 @@ class TemporalTransformer(nn.Module):
             x = rearrange(x, '(b hw) t c -> b hw t c', b=b).contiguous()
         else:
             x = rearrange(x, '(b hw) t c -> b hw t c', b=b).contiguous()
-            context = rearrange(context, '(b t) l con -> b t l con', t=t).contiguous()
+            ## one context per video, see UNetModel.forward
+            context = repeat(context, 'b l con -> b t l con', t=t)
             for i, block in enumerate(self.transformer_blocks):
                 # calculate each batch one by one (since number in shape could not greater then 65,535 for some package)
                 for j in range(b):
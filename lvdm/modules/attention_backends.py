@@ -0,0 +1,151 @@
+import time
+import torch
+import torch.nn.functional as F
+
+try:
+    import xformers
+    import xformers.ops
+    XFORMERS_IS_AVAILBLE = True
+except:
+    XFORMERS_IS_AVAILBLE = False
+SDPA_IS_AVAILABLE = hasattr(F, 'scaled_dot_product_attention')
+
+
+## every backend computes softmax(q k^T / sqrt(d)) v for q, k, v of shape (b, h, ..., n, d).
+## mask is an optional boolean mask broadcastable to (b, h, ..., n_q, n_k), True where attending.
+## callers fold extra dims into b: torch 2.0's flash and memory-efficient SDPA kernels only take
+## 4-D (b, h, n, d) inputs and fall back to the math kernel, which builds the full probabilities.
+
+def xformers_attention(q, k, v, mask=None):
+    if mask is not None:
+        raise NotImplementedError
+    shape = q.shape
+    q, k, v = map(lambda t: t.flatten(0, -3).contiguous(), (q, k, v))
+    out = xformers.ops.memory_efficient_attention(q, k, v, attn_bias=None, op=None)
+    return out.reshape(shape)
+
+
+def sdpa_attention(q, k, v, mask=None):
+    return F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+
+
+def chunked_attention(q, k, v, mask=None, max_elements=2 ** 26):
+    """
+    Softmax attention over chunks of the flattened (batch, heads, ..., queries) rows, each
+    chunk holding at most `max_elements` similarities (plus their softmax). Runs in one go
+    when the whole similarity tensor fits the budget, e.g. for short text contexts.
+    """
+    shape, n_q, n_k = q.shape, q.shape[-2], k.shape[-2]
+    if shape[:-1].numel() * n_k <= max_elements:
+        return einsum_attention(q, k, v, mask)
+    scale = shape[-1] ** -0.5
+    q, k, v = q.reshape(-1, n_q, shape[-1]), k.reshape(-1, n_k, k.shape[-1]), v.reshape(-1, n_k, v.shape[-1])
+    if mask is not None:
+        mask = mask.expand(*shape[:-2], *mask.shape[-2:]).reshape(-1, *mask.shape[-2:])
+    ## whole (batch, heads) slices per chunk when they fit, else query chunks of a single slice
+    queries = max(max_elements // n_k, 1)
+    batch, queries = max(queries // n_q, 1), min(queries, n_q)
+    out = q.new_empty(*q.shape[:-1], v.shape[-1])
+    for b in range(0, q.shape[0], batch):
+        k_b, v_b = k[b:b + batch], v[b:b + batch]
+        for i in range(0, n_q, queries):
+            sim = torch.einsum('b i d, b j d -> b i j', q[b:b + batch, i:i + queries], k_b) * scale
+            if mask is not None:
+                mask_i = mask[b:b + batch, i:i + queries] if mask.shape[-2] > 1 else mask[b:b + batch]
+                sim.masked_fill_(~mask_i, -torch.finfo(sim.dtype).max)
+            out[b:b + batch, i:i + queries] = torch.einsum('b i j, b j d -> b i d', sim.softmax(dim=-1), v_b)
+            del sim
+    return out.reshape(*shape[:-1], v.shape[-1])
+
+
+def einsum_attention(q, k, v, mask=None):
+    ## the reference: builds the whole similarity matrix
+    sim = torch.einsum('... i d, ... j d -> ... i j', q, k) * q.shape[-1] ** -0.5
+    if mask is not None:
+        sim = sim.masked_fill(~mask, -torch.finfo(sim.dtype).max)
+    return torch.einsum('... i j, ... j d -> ... i d', sim.softmax(dim=-1), v)
+
+
+ATTENTION_BACKENDS = {
+    'xformers': xformers_attention,
+    'sdpa': sdpa_attention,
+    'chunked': chunked_attention,
+    'einsum': einsum_attention,
+}
+
+## where attention runs: spatial self/cross attention over the hw tokens of a frame,
+## and the long-frame and short-window branches of the temporal attention
+ATTENTION_ROLES = ('spatial_self', 'spatial_cross', 'temporal_long', 'temporal_window')
+
+## backend of every role; None picks a default for the device, 'auto' benchmarks the candidates
+_role_backends = {role: None for role in ATTENTION_ROLES}
+## fastest backend found by 'auto', per role and call shape
+_autotuned = {}
+
+
+def available_backends():
+    return [name for name in ATTENTION_BACKENDS
+            if (name != 'xformers' or XFORMERS_IS_AVAILBLE) and (name != 'sdpa' or SDPA_IS_AVAILABLE)]
+
+
+def set_attention_backend(role, name):
+    if role not in ATTENTION_ROLES:
+        raise ValueError(f"attention role '{role}' unknown, choose from {list(ATTENTION_ROLES)}")
+    if name is not None and name != 'auto' and name not in available_backends():
+        raise ValueError(f"attention backend '{name}' unavailable, choose from {available_backends() + ['auto']}")
+    _role_backends[role] = name
+
+
+def default_backend(role, q, mask=None):
+    if role.startswith('spatial'):
+        ## on CPU, torch SDPA still builds the full (hw x hw) matrix, so queries are chunked instead
+        if XFORMERS_IS_AVAILBLE and q.is_cuda and mask is None:
+            return 'xformers'
+        return 'sdpa' if SDPA_IS_AVAILABLE and q.is_cuda else 'chunked'
+    return 'sdpa' if SDPA_IS_AVAILABLE else 'einsum'
+
+
+def autotune(role, q, k, v, mask=None, repeat=3):
+    """
+    Time every available backend on the actual call (q, k, v, mask) and keep the
+    fastest for this role and shape. Backends that fail (unsupported mask, out of
+    memory) are skipped. The decision is logged once per role and shape.
+    """
+    key = (role, tuple(q.shape), tuple(k.shape), None if mask is None else tuple(mask.shape), q.device, q.dtype)
+    if key not in _autotuned:
+        timings = {}
+        for name in available_backends():
+            try:
+                ATTENTION_BACKENDS[name](q, k, v, mask)
+                if q.is_cuda:
+                    torch.cuda.synchronize(q.device)
+                start = time.time()
+                for _ in range(repeat):
+                    ATTENTION_BACKENDS[name](q, k, v, mask)
+                if q.is_cuda:
+                    torch.cuda.synchronize(q.device)
+                timings[name] = (time.time() - start) / repeat
+            except (NotImplementedError, RuntimeError):
+                if q.is_cuda:
+                    torch.cuda.empty_cache()
+        ## nothing ran (e.g. out of memory everywhere): keep the device default
+        _autotuned[key] = min(timings, key=timings.get) if timings else default_backend(role, q, mask)
+        report = ', '.join(f"{name} {seconds * 1000.:.2f}ms" for name, seconds in timings.items())
+        print(f">>> attention backend for {role} q{tuple(q.shape)} k{tuple(k.shape)}: {_autotuned[key]} ({report})")
+    return _autotuned[key]
+
+
+def run_attention(role, q, k, v, mask=None, backend=None):
+    """
+    Run attention for `role` with `backend`, or with the backend selected for the
+    role (set_attention_backend) when backend is None.
+    """
+    name = backend if backend is not None else _role_backends[role]
+    if name is None:
+        name = default_backend(role, q, mask)
+    elif name == 'auto':
+        name = autotune(role, q, k, v, mask)
+    if name == 'xformers' and mask is not None:
+        ## xformers takes no boolean mask (e.g. causal temporal attention)
+        name = default_backend(role, q, mask)
+    return ATTENTION_BACKENDS[name](q, k, v, mask)
@@ -0,0 +1,352 @@
+import math
+from functools import lru_cache
+import torch
+import torch.nn.functional as F
+from einops import rearrange
+
+
+class ViewPlan(object):
+    """
+    Short-window views of a video of `video_length` frames and the attention-entropy
+    scale of its long-frame branch. Windows are `window_size` frames, `stride` apart
+    (at most `window_size`, so that every frame is covered); a last window is aligned
+    to the end when the stride does not land on it.
+    Overlapping window outputs are blended with the `blend_kernel` weights of BLEND_KERNELS.
+    """
+    def __init__(self, video_length, window_size=16, stride=4, temporal_length=16, blend_kernel='uniform'):
+        self.video_length = video_length
+        self.blend_kernel = blend_kernel
+        self.window_size = window_size = min(window_size, video_length)
+        if stride > window_size and window_size < video_length:
+            ## frames between two windows would have no short-window output at all
+            raise ValueError(f"window stride {stride} exceeds the window size {window_size}, frames would be left uncovered")
+        self.stride = stride
+        num_blocks_time = (video_length - window_size) // stride + 1
+        views = []
+        for i in range(num_blocks_time):
+            t_start = int(i * stride)
+            t_end = t_start + window_size
+            views.append((t_start,t_end))
+        if views[-1][1] < video_length:
+            views.append((video_length - window_size, video_length))
+        self.views = views
+        ## attention entropy: keep the long-frame softmax as sharp as at the training length
+        self.entropy_scale = max(math.log(video_length, temporal_length), 1.) ** 0.5
+        self._index = {}
+        self._blend_weights = {}
+
+    def index(self, device):
+        ## (num_views, window) frame index, kept on every device it was asked for
+        if device not in self._index:
+            self._index[device] = torch.tensor(views_index(self.views), device=device)
+        return self._index[device]
+
+    def blend_weights(self, device, dtype):
+        """
+        Blending weight of every view position (num_views, window), with the overlap
+        normalisation folded in: the weights landing on any covered frame sum to one.
+        """
+        if (device, dtype) not in self._blend_weights:
+            weight = torch.tensor([generate_weight_sequence(self.window_size, self.blend_kernel)] * len(self.views), dtype=torch.float64)
+            index = torch.tensor(views_index(self.views))
+            count = torch.zeros(self.video_length, dtype=torch.float64).index_add_(0, index.flatten(), weight.flatten())
+            weight = weight / torch.where(count > 0, count, torch.ones_like(count))[index]
+            self._blend_weights[(device, dtype)] = weight.to(device=device, dtype=dtype)
+        return self._blend_weights[(device, dtype)]
+
+
+def uniform_kernel(window_size):
+    return [1.] * window_size
+
+
+def triangular_kernel(window_size):
+    ## rises towards the window center; the edge frames keep a small nonzero weight
+    half = (window_size + 1) // 2
+    return [min(i + 1, window_size - i) / half for i in range(window_size)]
+
+
+def gaussian_kernel(window_size, sigma=0.25):
+    center = (window_size - 1) / 2
+    return [math.exp(-0.5 * ((i - center) / (sigma * window_size)) ** 2) for i in range(window_size)]
+
+
+def cosine_kernel(window_size):
+    ## half-sample shifted sine window, positive on every frame
+    return [math.sin(math.pi * (i + 0.5) / window_size) for i in range(window_size)]
+
+
+## weights for blending overlapping short-window outputs; tapered kernels hide window seams at larger strides
+BLEND_KERNELS = {
+    'uniform': uniform_kernel,
+    'triangular': triangular_kernel,
+    'gaussian': gaussian_kernel,
+    'cosine': cosine_kernel,
+}
+
+
+def generate_weight_sequence(window_size=16, blend_kernel='uniform'):
+    if blend_kernel not in BLEND_KERNELS:
+        raise ValueError(f"blend kernel '{blend_kernel}' unknown, choose from {list(BLEND_KERNELS.keys())}")
+    return BLEND_KERNELS[blend_kernel](window_size) # weight_sequence
+
+
+@lru_cache(maxsize=None)
+def get_view_plan(video_length, window_size=16, stride=4, temporal_length=16, blend_kernel='uniform'):
+    return ViewPlan(video_length, window_size, stride, temporal_length, blend_kernel)
+
+
+def gather_views(t, views):
+    """
+    Stack the frames of every (t_start, t_end) view into one tensor.
+    t: (b, n, d) -> (b, num_views, window, d). Evenly spaced views are taken as a
+    strided (unfold) view of t, so no frames are copied.
+    """
+    window = views[0][1] - views[0][0]
+    stride = views[1][0] - views[0][0] if len(views) > 1 else window
+    if all(t_start == i * stride + views[0][0] and t_end - t_start == window for i, (t_start, t_end) in enumerate(views)):
+        return t[:, views[0][0]:].unfold(1, window, stride)[:, :len(views)].transpose(-1, -2)
+    index = torch.tensor(views_index(views), device=t.device)
+    return t[:, index]
+
+
+def views_index(views):
+    ## frame index of every view position, in view order
+    return [list(range(t_start, t_end)) for t_start, t_end in views]
+
+
+def covariance(data):
+    ## data: (..., w, r, n) centered rows -> (..., w, n, n)
+    return torch.matmul(data.transpose(-1, -2), data) / (data.shape[-1] - 1)
+
+
+def pca_basis(cov_matrix):
+    """
+    Principal axes of a batch of covariance matrices (w, n, n), one component per column.
+    The covariance is symmetric, so the real symmetric solver is used and
+    everything stays real-valued.
+    """
+    ## eigh has no half precision kernel
+    eigenvalues, eigenvectors = torch.linalg.eigh(cov_matrix.float())
+    return eigenvectors.to(cov_matrix.dtype)
+
+
+@lru_cache(maxsize=None)
+def dct_basis(n, device=None, dtype=torch.float32):
+    """
+    Orthonormal DCT-II basis over n frames (n, n), one component per column, ordered
+    from the temporal mean to the fastest oscillation. A data-independent stand-in for
+    the eigenbasis of the fixed-basis fusion, built once per window size.
+    """
+    frame = torch.arange(n, dtype=torch.float64)
+    freq = torch.arange(n, dtype=torch.float64)
+    basis = torch.cos(math.pi * (frame[:, None] + 0.5) * freq[None, :] / n) * math.sqrt(2. / n)
+    basis[:, 0] = basis[:, 0] / math.sqrt(2.)
+    return basis.to(device=device, dtype=dtype)
+
+
+## bases the fusion projects onto: 'eigen' is the exact data-dependent PCA,
+## 'dct' the fixed approximation that skips covariance and eigendecomposition
+FUSION_BASES = ('eigen', 'dct')
+
+
+def fusion_basis(comp_data=None, basis='eigen', basis_cache=None, key=None, cov_matrix=None):
+    ## basis of the centered long-frame rows (g, w, r, n), or of their covariance when given
+    if basis not in FUSION_BASES:
+        raise ValueError(f"fusion basis '{basis}' unknown, choose from {list(FUSION_BASES)}")
+    reference = comp_data if cov_matrix is None else cov_matrix
+    if basis == 'dct':
+        return dct_basis(reference.shape[-1], reference.device, reference.dtype)
+    if basis_cache is None:
+        return pca_basis(covariance(comp_data) if cov_matrix is None else cov_matrix)
+    ## the covariance is only built when the cache misses or checks the drift
+    return basis_cache.basis(key, (lambda: covariance(comp_data)) if cov_matrix is None else (lambda: cov_matrix))
+
+
+def basis_drift(eigenvectors, cov_matrix):
+    ## share of the covariance energy that the basis no longer diagonalises, worst window
+    rotated = torch.matmul(eigenvectors.transpose(-1, -2), torch.matmul(cov_matrix, eigenvectors))
+    off_diagonal = rotated - torch.diag_embed(torch.diagonal(rotated, dim1=-2, dim2=-1))
+    return (off_diagonal.flatten(-2).norm(dim=-1) / rotated.flatten(-2).norm(dim=-1).clamp(min=1e-12)).max()
+
+
+class EigenbasisCache(object):
+    """
+    Eigenbases of one attention layer kept across denoising steps, keyed by window.
+    A basis is reused for at most `max_age` steps, and recomputed earlier once its
+    drift on the current covariance exceeds `drift_threshold` (checking the drift
+    costs one host sync; None skips the check).
+    Calls at the same timestep (e.g. the conditional and unconditional passes) are
+    told apart by their order, so each keeps its own basis.
+    """
+    def __init__(self, max_age=5, drift_threshold=None):
+        self.max_age = max_age
+        self.drift_threshold = drift_threshold
+        self.bases = {}
+        self.t = None
+        self.step = 0
+        self.call = 0
+
+    def update(self, t):
+        ## called once per forward with the current timestep
+        if self.t is not None and t > self.t:
+            ## timesteps only decrease within a sampling run: a new run has started
+            self.bases = {}
+        if t == self.t:
+            self.call += 1
+        else:
+            self.step += 1
+            self.call = 0
+        self.t = t
+
+    def basis(self, key, get_cov_matrix):
+        ## get_cov_matrix() builds the current covariance; a fresh entry without drift check never calls it
+        key = (self.call, key)
+        entry = self.bases.get(key)
+        cov_matrix = None
+        if entry is not None and self.step - entry[1] < self.max_age:
+            eigenvectors = entry[0]
+            if self.drift_threshold is None:
+                return eigenvectors
+            cov_matrix = get_cov_matrix()
+            if basis_drift(eigenvectors, cov_matrix) <= self.drift_threshold:
+                return eigenvectors
+        eigenvectors = pca_basis(get_cov_matrix() if cov_matrix is None else cov_matrix)
+        self.bases[key] = (eigenvectors, self.step)
+        return eigenvectors
+
+
+class FreePCAPolicy(object):
+    """
+    Decides per layer and timestep which branches of the temporal self-attention run:
+    'fuse' (short windows fused with the long-frame branch), 'short' (short windows only,
+    the long-frame branch is skipped) or 'long' (long-frame branch only).
+    Fusion runs above `fuse_timestep` in the `fuse_layers` (None: every layer); the
+    `long_layers` always take the long-frame branch alone. Window p keeps
+    min(p, max_components) long-frame components, so the first window is never fused.
+    """
+    def __init__(self, fuse_timestep=250, max_components=3, fuse_layers=None, long_layers=None):
+        self.fuse_timestep = fuse_timestep
+        self.max_components = max_components
+        self.fuse_layers = None if fuse_layers is None else set(fuse_layers)
+        self.long_layers = set() if long_layers is None else set(long_layers)
+
+    def mode(self, num_layer, timestep):
+        if num_layer in self.long_layers:
+            return 'long'
+        if timestep > self.fuse_timestep and (self.fuse_layers is None or num_layer in self.fuse_layers):
+            return 'fuse'
+        return 'short'
+
+    def selected_k(self, num_views):
+        ## long-frame components kept by every view
+        return [min(preserve, self.max_components) for preserve in range(num_views)]
+
+
+def centered_rows(t, groups=1):
+    """
+    (b, w, n, d) -> every (b d) row of every window centered over its n frames, and its
+    mean, (g, w, (b d), n). The batch is split into `groups` independent groups (e.g. the
+    conditional and unconditional halves of a fused CFG pass), each with its own PCA.
+    """
+    rows = rearrange(t, '(g b) w n d -> g w (b d) n', g=groups)
+    mean = torch.mean(rows, dim=-1, keepdim=True)
+    return rows - mean, mean
+
+
+def freepca_fuse(out, com_out, selected_k, basis_cache=None, key=None, basis='eigen', groups=1):
+    """
+    Consistency feature decomposition and progressive fusion of a batch of windows.
+    out: short-window outputs (b, w, n, d).
+    com_out: long-frame output clipped to the same windows (b, w, n, d).
+    selected_k: number of long-frame components kept, one entry per window.
+    basis_cache: optional EigenbasisCache to reuse the eigenbasis stored under `key`.
+    basis: one of FUSION_BASES.
+    groups: batch groups fused independently, see centered_rows.
+    """
+    dim_d = out.shape[-1]
+    # Consistency Feature Decomposition
+    ref_data, ref_mean = centered_rows(out, groups)
+    comp_data, comp_mean = centered_rows(com_out, groups)
+
+    eigenvectors = fusion_basis(comp_data, basis, basis_cache, key)
+
+    origin_pca = torch.matmul(ref_data, eigenvectors)
+    comp_pca = torch.matmul(comp_data, eigenvectors)
+
+    ## rank the components of every window at once, without leaving the device
+    cos_similarities = mask_mean_component(F.cosine_similarity(origin_pca, comp_pca, dim=-2), eigenvectors)
+    # Progressive Fusion
+    keep_comp = select_components(cos_similarities, selected_k).unsqueeze(-2)
+    fuse_pca = torch.where(keep_comp, comp_pca, origin_pca)
+
+    out = torch.matmul(fuse_pca, eigenvectors.transpose(-1, -2)) + comp_mean
+    return rearrange(out, 'g w (b d) n -> (g b) w n d', d=dim_d)
+
+
+def mask_mean_component(cos_similarities, eigenvectors):
+    """
+    Rank the component along the frame mean last in every window, so it is never taken
+    from the long frames. The rows are centered, so that component carries no energy
+    (eigenvalue ~0, the DC column of the DCT) and its cosine is numerical noise that
+    differs between the direct and the chunked (Gram) computation.
+    """
+    mean_component = eigenvectors.sum(dim=-2).abs().argmax(dim=-1, keepdim=True)
+    ## a fixed basis (n, n) has one mean component for all windows
+    mean_component = mean_component.expand(*cos_similarities.shape[:-1], 1)
+    return cos_similarities.scatter(-1, mean_component, float('-inf'))
+
+
+def select_components(cos_similarities, selected_k):
+    ## (g, w, n) mask of the selected_k[w] components of every window most similar to the long frames
+    sorted_indices = torch.argsort(cos_similarities, dim=-1, descending=True)
+    ranks = torch.argsort(sorted_indices, dim=-1)
+    selected_k = torch.as_tensor(selected_k, device=ranks.device)
+    return ranks < selected_k[:, None]
+
+
+def fusion_statistics(out, com_out):
+    """
+    Gram matrices of the centered short-window (ref) and long-frame (comp) rows of one
+    chunk, stacked as (ref^T ref, ref^T comp, comp^T comp), each (1, w, n, n). They add up
+    over chunks, so the fusion of the whole grid can be derived from their sum.
+    """
+    ref_data, _ = centered_rows(out)
+    comp_data, _ = centered_rows(com_out)
+    ## accumulate in float32, a whole grid of rows overflows half precision
+    ref_data, comp_data = ref_data.float(), comp_data.float()
+    ref_t = ref_data.transpose(-1, -2)
+    return torch.stack([torch.matmul(ref_t, ref_data),
+                        torch.matmul(ref_t, comp_data),
+                        torch.matmul(comp_data.transpose(-1, -2), comp_data)])
+
+
+def fusion_operator(stats, selected_k, basis_cache=None, key=None, basis='eigen'):
+    """
+    Progressive fusion as a pair of (1, w, n, n) maps, so that a chunk fuses as
+    ref_data @ to_ref + comp_data @ to_comp + comp_mean; same result as freepca_fuse.
+    stats: summed fusion_statistics of every chunk.
+    """
+    gram_ref, gram_cross, gram_comp = stats
+    cov_matrix = gram_comp / (gram_comp.shape[-1] - 1)
+    eigenvectors = fusion_basis(basis=basis, basis_cache=basis_cache, key=key, cov_matrix=cov_matrix)
+
+    ## per-component dot products and norms of the projections, from the Gram matrices
+    project = lambda gram: torch.diagonal(torch.matmul(eigenvectors.transpose(-1, -2), torch.matmul(gram, eigenvectors)), dim1=-2, dim2=-1)
+    dot, norm_ref, norm_comp = project(gram_cross), project(gram_ref), project(gram_comp)
+    cos_similarities = (dot / (norm_ref * norm_comp).clamp(min=1e-16).sqrt()).clamp(-1., 1.)
+    cos_similarities = mask_mean_component(cos_similarities, eigenvectors)
+    # Progressive Fusion
+    keep_comp = select_components(cos_similarities, selected_k).to(eigenvectors.dtype)
+    to_comp = torch.matmul(eigenvectors * keep_comp[..., None, :], eigenvectors.transpose(-1, -2))
+    to_ref = torch.matmul(eigenvectors * (1 - keep_comp)[..., None, :], eigenvectors.transpose(-1, -2))
+    return to_ref, to_comp
+
+
+def apply_fusion(out, com_out, operator):
+    ## fuse one chunk with the maps of fusion_operator: (b, w, n, d) -> (b, w, n, d)
+    dim_d = out.shape[-1]
+    to_ref, to_comp = operator
+    ref_data, ref_mean = centered_rows(out)
+    comp_data, comp_mean = centered_rows(com_out)
+    out = torch.matmul(ref_data, to_ref.to(out.dtype)) + torch.matmul(comp_data, to_comp.to(out.dtype)) + comp_mean
+    return rearrange(out, 'g w (b d) n -> (g b) w n d', d=dim_d)
@@ -317,6 +317,8 @@ class UNetModel(nn.Module):
                                of heads for upsampling. Deprecated.
     :param use_scale_shift_norm: use a FiLM-like conditioning mechanism.
     :param resblock_updown: use residual blocks for up/downsampling.
+    :param freepca_config: options of the FreePCA temporal attention (window_size,
+                           window_stride, ...), passed on to every temporal CrossAttention.
     """
 
     def __init__(self,
@@ -349,6 +351,7 @@ class UNetModel(nn.Module):
                  use_image_attention=False,
                  temporal_transformer_depth=1,
                  fps_cond=False,
+                 freepca_config=None,
                 ):
         super(UNetModel, self).__init__()
         if num_heads == -1:
@@ -401,7 +404,7 @@ class UNetModel(nn.Module):
                     context_dim=context_dim,
                     use_checkpoint=use_checkpoint, only_self_att=temporal_selfatt_only, 
                     causal_attention=use_causal_attention, relative_position=use_relative_position, 
-                    temporal_length=temporal_length))
+                    temporal_length=temporal_length, freepca_config=freepca_config))
             
         input_block_chans = [model_channels]
         ch = model_channels
@@ -435,7 +438,7 @@ class UNetModel(nn.Module):
                                 depth=temporal_transformer_depth, context_dim=context_dim, use_linear=use_linear,
                                 use_checkpoint=use_checkpoint, only_self_att=temporal_selfatt_only, 
                                 causal_attention=use_causal_attention, relative_position=use_relative_position, 
-                                temporal_length=temporal_length
+                                temporal_length=temporal_length, freepca_config=freepca_config
                             )
                         )
                 self.input_blocks.append(TimestepEmbedSequential(*layers))
@@ -480,7 +483,7 @@ class UNetModel(nn.Module):
                     depth=temporal_transformer_depth, context_dim=context_dim, use_linear=use_linear,
                     use_checkpoint=use_checkpoint, only_self_att=temporal_selfatt_only, 
                     causal_attention=use_causal_attention, relative_position=use_relative_position, 
-                    temporal_length=temporal_length
+                    temporal_length=temporal_length, freepca_config=freepca_config
                 )
             )
         layers.append(
@@ -523,7 +526,7 @@ class UNetModel(nn.Module):
                                 depth=temporal_transformer_depth, context_dim=context_dim, use_linear=use_linear,
                                 use_checkpoint=use_checkpoint, only_self_att=temporal_selfatt_only, 
                                 causal_attention=use_causal_attention, relative_position=use_relative_position, 
-                                temporal_length=temporal_length
+                                temporal_length=temporal_length, freepca_config=freepca_config
                             )
                         )
                 if level and i == num_res_blocks:
@@ -559,9 +562,12 @@ class UNetModel(nn.Module):
             fps_emb = timestep_embedding(fps,self.model_channels, repeat_only=False)
             emb += self.fps_embedding(fps_emb)
 
+        ## the temporal layers pick their FreePCA branches from the timestep: read it on the host once per call
+        timestep = int(timesteps.flatten()[0])
+
         b,_,t,_,_ = x.shape
-        ## repeat t times for context [(b t) 77 768] & time embedding
-        context = context.repeat_interleave(repeats=t, dim=0)
+        ## repeat t times for time embedding; the context stays one per video [b 77 768],
+        ## cross-attention broadcasts it over the t frames of its video
         emb = emb.repeat_interleave(repeats=t, dim=0)
 
         ## always in shape (b t) c h w, except for temporal layer
@@ -571,10 +577,10 @@ class UNetModel(nn.Module):
         adapter_idx = 0
         hs = []
         for id, module in enumerate(self.input_blocks):
-            h = module(h, emb, context=context, batch_size=b, timesteps=timesteps, num_layer=self.num_layer)
+            h = module(h, emb, context=context, batch_size=b, timesteps=timestep, num_layer=self.num_layer)
             self.num_layer += 1
             if id ==0 and self.addition_attention:
-                h = self.init_attn(h, emb, context=context, batch_size=b, timesteps=timesteps, num_layer=self.num_layer)
+                h = self.init_attn(h, emb, context=context, batch_size=b, timesteps=timestep, num_layer=self.num_layer)
                 self.num_layer += 1
             ## plug-in adapter features
             if ((id+1)%3 == 0) and features_adapter is not None:
@@ -584,11 +590,11 @@ class UNetModel(nn.Module):
         if features_adapter is not None:
             assert len(features_adapter)==adapter_idx, 'Wrong features_adapter'
 
-        h = self.middle_block(h, emb, context=context, batch_size=b, timesteps=timesteps, num_layer=self.num_layer)
+        h = self.middle_block(h, emb, context=context, batch_size=b, timesteps=timestep, num_layer=self.num_layer)
         self.num_layer += 1
         for module in self.output_blocks:
             h = torch.cat([h, hs.pop()], dim=1)
-            h = module(h, emb, context=context, batch_size=b, timesteps=timesteps, num_layer=self.num_layer)
+            h = module(h, emb, context=context, batch_size=b, timesteps=timestep, num_layer=self.num_layer)
             self.num_layer += 1
         h = h.type(x.dtype)
         y = self.out(h)
@@ -21,6 +21,7 @@ from funcs import (
     get_filelist,
 )
 from utils.utils import instantiate_from_config
+from lvdm.basics import prepare_for_inference
 
 
 class Predictor(BasePredictor):
@@ -37,14 +38,14 @@ class Predictor(BasePredictor):
         self.model_base = instantiate_from_config(model_config_base)
         self.model_base = self.model_base.cuda()
         self.model_base = load_model_checkpoint(self.model_base, ckpt_path_base)
-        self.model_base.eval()
+        self.model_base = prepare_for_inference(self.model_base)
 
         config_i2v = OmegaConf.load(config_i2v)
         model_config_i2v = config_i2v.pop("model", OmegaConf.create())
         self.model_i2v = instantiate_from_config(model_config_i2v)
         self.model_i2v = self.model_i2v.cuda()
         self.model_i2v = load_model_checkpoint(self.model_i2v, ckpt_path_i2v)
-        self.model_i2v.eval()
+        self.model_i2v = prepare_for_inference(self.model_i2v)
 
     def predict(
         self,
@@ -8,17 +8,15 @@ import torch
 import torchvision
 sys.path.insert(1, os.path.join(sys.path[0], '..', '..'))
 from lvdm.models.samplers.ddim import DDIMSampler
+from lvdm.models.samplers.dpm_solver import DPMSolverSampler
+from lvdm.common import default
 
 
 
-def batch_ddim_sampling(model, cond, noise_shape, n_samples=1, ddim_steps=50, ddim_eta=1.0,\
-                        cfg_scale=1.0, temporal_cfg_scale=None, args=None, x_T_total=None, **kwargs):
-    ddim_sampler = DDIMSampler(model)
+def get_unconditional_conditioning(model, cond, batch_size, cfg_scale=1.0):
     uncond_type = model.uncond_type
-    batch_size = noise_shape[0]
-
-    ## construct unconditional guidance
-    if cfg_scale != 1.0:
+    ## construct unconditional guidance (cfg_scale: a float or one scale per step)
+    if np.any(np.asarray(cfg_scale) != 1.0):
         if uncond_type == "empty_seq":
             prompts = batch_size * [""]
             #prompts = N * T * [""]  ## if is_imgbatch=True
@@ -29,7 +27,7 @@ def batch_ddim_sampling(model, cond, noise_shape, n_samples=1, ddim_steps=50, dd
                 
         ## process image embedding token
         if hasattr(model, 'embedder'):
-            uc_img = torch.zeros(noise_shape[0],3,224,224).to(model.device)
+            uc_img = torch.zeros(batch_size,3,224,224).to(model.device)
             ## img: b c h w >> b l c
             uc_img = model.get_image_embeds(uc_img)
             uc_emb = torch.cat([uc_emb, uc_img], dim=1)
@@ -41,6 +39,39 @@ def batch_ddim_sampling(model, cond, noise_shape, n_samples=1, ddim_steps=50, dd
             uc = uc_emb
     else:
         uc = None
+    return uc
+
+
+SAMPLERS = {'ddim': DDIMSampler, 'dpm_solver': DPMSolverSampler}
+
+
+def get_sampler(model, sampler='ddim'):
+    ## one sampler of each kind per model, so its schedules are built once and reused by every batch
+    if getattr(model, '_samplers', None) is None:
+        model._samplers = {}
+    if sampler not in model._samplers:
+        model._samplers[sampler] = SAMPLERS[sampler](model)
+    return model._samplers[sampler]
+
+
+def sampling_steps(model, ddim_steps, sampler='ddim'):
+    ## steps the sampler runs for ddim_steps; the uniform discretization can yield one more
+    ddim_sampler = get_sampler(model, sampler)
+    ddim_sampler.make_schedule(ddim_num_steps=ddim_steps, verbose=False)
+    return len(ddim_sampler.ddim_timesteps)
+
+
+def batch_ddim_sampling(model, cond, noise_shape, n_samples=1, ddim_steps=50, ddim_eta=1.0,\
+                        cfg_scale=1.0, temporal_cfg_scale=None, args=None, x_T_total=None, sampler='ddim',\
+                        guidance_interval=None, **kwargs):
+    """
+    cfg_scale: a float, or one guidance scale per sampling step.
+    guidance_interval: (start, end) sampling steps with guidance; outside of it the
+    unconditional pass is skipped.
+    """
+    ddim_sampler = get_sampler(model, sampler)
+    batch_size = noise_shape[0]
+    uc = get_unconditional_conditioning(model, cond, batch_size, cfg_scale)
     
     x_T = None
 
@@ -61,6 +92,7 @@ def batch_ddim_sampling(model, cond, noise_shape, n_samples=1, ddim_steps=50, dd
                                             temporal_length=noise_shape[2],
                                             conditional_guidance_scale_temporal=temporal_cfg_scale,
                                             x_T=x_T,
+                                            guidance_interval=guidance_interval,
                                             **kwargs
                                             )
         ## reconstruct from latent to pixel space
@@ -71,6 +103,82 @@ def batch_ddim_sampling(model, cond, noise_shape, n_samples=1, ddim_steps=50, dd
     return batch_variants
 
 
+def streaming_ddim_sampling(model, cond, noise_shape, frames, n_samples=1, ddim_steps=50, ddim_eta=1.0,\
+                            cfg_scale=1.0, temporal_cfg_scale=None, noise_fn=None, context_frames=16,\
+                            memory_frames=16, memory_stride=8, sampler='ddim', **kwargs):
+    """
+    Generate a video of any number of frames as a stream of segments, with a working set
+    of fixed size. noise_shape is [b, c, window, h, w], the working set denoised at once.
+    It holds the compact summary of what is already generated plus new noise:
+    - the clean latents of the last `context_frames` frames,
+    - at most `memory_frames` keyframe latents of the older frames. They start
+      `memory_stride` frames apart and are thinned out to every other one when full.
+    The summary frames are re-noised to every timestep and kept fixed (mask/x0 of the
+    DDIM sampler), so the long-frame branch and the FreePCA fusion of the new frames
+    see the whole past. Yields decoded segments (b, <samples>, c, t, H, W), in order.
+    noise_fn(window): initial noise (n_samples, b, c, window, h, w).
+    sampler: 'ddim' or 'dpm_solver' (SAMPLERS).
+    """
+    ddim_sampler = get_sampler(model, sampler)
+    batch_size, window = noise_shape[0], noise_shape[2]
+    assert context_frames + memory_frames < window, "Error: stream context and memory must leave room for new frames!"
+    uc = get_unconditional_conditioning(model, cond, batch_size, cfg_scale)
+    noise_fn = default(noise_fn, lambda window: torch.randn([n_samples, *noise_shape[:2], window, *noise_shape[3:]], device=model.device))
+
+    ## per sample: latents of the context frames and of the keyframes, and where the keyframes are
+    contexts, memories, keyframes = [None] * n_samples, [None] * n_samples, []
+    num_done = 0
+    while num_done < frames:
+        x_T_total = noise_fn(window)
+        num_context = 0 if contexts[0] is None else contexts[0].shape[2]
+        num_known = num_context + len(keyframes)
+        num_new = min(window - num_known, frames - num_done)
+        batch_variants = []
+        for n in range(n_samples):
+            x_T = x_T_total[n][:batch_size]
+            if num_known > 0:
+                known = torch.cat([m for m in (memories[n], contexts[n]) if m is not None], dim=2)
+                mask = torch.zeros_like(x_T[:, :1])
+                mask[:, :, :num_known] = 1.
+                x0 = torch.zeros_like(x_T)
+                x0[:, :, :num_known] = known
+            else:
+                mask = x0 = None
+            samples, _ = ddim_sampler.sample(S=ddim_steps,
+                                            conditioning=cond,
+                                            batch_size=batch_size,
+                                            shape=noise_shape[1:],
+                                            verbose=False,
+                                            unconditional_guidance_scale=cfg_scale,
+                                            unconditional_conditioning=uc,
+                                            eta=ddim_eta,
+                                            temporal_length=window,
+                                            conditional_guidance_scale_temporal=temporal_cfg_scale,
+                                            x_T=x_T,
+                                            mask=mask, x0=x0,
+                                            clean_cond=False,
+                                            **kwargs
+                                            )
+            new = samples[:, :, num_known:num_known + num_new]
+            ## frames leaving the working set: only their keyframes stay behind
+            finished = new if contexts[n] is None else torch.cat([contexts[n], new], dim=2)
+            contexts[n] = finished[:, :, max(finished.shape[2] - context_frames, 0):]
+            leaving = finished[:, :, :finished.shape[2] - contexts[n].shape[2]]
+            first = num_done - num_context
+            picked = [i for i in range(leaving.shape[2]) if (first + i) % memory_stride == 0]
+            if len(picked) > 0:
+                memories[n] = leaving[:, :, picked] if memories[n] is None else torch.cat([memories[n], leaving[:, :, picked]], dim=2)
+            batch_variants.append(model.decode_first_stage_2DAE(new))
+        keyframes += [first + i for i in picked]
+        while len(keyframes) > memory_frames:
+            ## memory full: keep every other keyframe and halve how often new ones are taken
+            keyframes, memory_stride = keyframes[::2], memory_stride * 2
+            memories = [m[:, :, ::2] for m in memories]
+        num_done += num_new
+        ## batch, <samples>, c, t, h, w
+        yield torch.stack(batch_variants, dim=1)
+
+
 def get_filelist(data_dir, ext='*'):
     file_list = glob.glob(os.path.join(data_dir, '*.%s'%ext))
     file_list.sort()
@@ -181,17 +289,55 @@ def load_image_batch(filepath_list, image_size=(256,256)):
     return torch.stack(batch_tensor, dim=0)
 
 
+def video_grid(vid_tensor):
+    ## samples,c,t,h,w -> uint8 frames [t, h, n*w, 3], the samples side by side
+    n_samples = vid_tensor.shape[0]
+    video = vid_tensor.detach().cpu()
+    video = torch.clamp(video.float(), -1., 1.)
+    video = video.permute(2, 0, 1, 3, 4) # t,n,c,h,w
+    frame_grids = [torchvision.utils.make_grid(framesheet, nrow=int(n_samples)) for framesheet in video] #[3, 1*h, n*w]
+    grid = torch.stack(frame_grids, dim=0) # stack in temporal dim [t, 3, n*h, w]
+    grid = (grid + 1.0) / 2.0
+    return (grid * 255).to(torch.uint8).permute(0, 2, 3, 1)
+
+
 def save_videos(batch_tensors, savedir, filenames, fps=10):
     # b,samples,c,t,h,w
-    n_samples = batch_tensors.shape[1]
     for idx, vid_tensor in enumerate(batch_tensors):
-        video = vid_tensor.detach().cpu()
-        video = torch.clamp(video.float(), -1., 1.)
-        video = video.permute(2, 0, 1, 3, 4) # t,n,c,h,w
-        frame_grids = [torchvision.utils.make_grid(framesheet, nrow=int(n_samples)) for framesheet in video] #[3, 1*h, n*w]
-        grid = torch.stack(frame_grids, dim=0) # stack in temporal dim [t, 3, n*h, w]
-        grid = (grid + 1.0) / 2.0
-        grid = (grid * 255).to(torch.uint8).permute(0, 2, 3, 1)
+        grid = video_grid(vid_tensor)
         savepath = os.path.join(savedir, f"{filenames[idx]}.mp4")
         torchvision.io.write_video(savepath, grid, fps=fps, video_codec='h264', options={'crf': '10'})
 
+
+class StreamingVideoWriter(object):
+    """
+    Writes the mp4 videos of a batch segment by segment, as the frames are generated,
+    with the encoding settings of save_videos. Segments are (b, <samples>, c, t, h, w).
+    """
+    def __init__(self, savedir, filenames, fps=10):
+        import av
+        self.av = av
+        self.fps = int(round(float(fps)))
+        self.containers = [av.open(os.path.join(savedir, f"{filename}.mp4"), mode='w') for filename in filenames]
+        self.streams = [None] * len(filenames)
+
+    def write(self, batch_tensors):
+        for idx, vid_tensor in enumerate(batch_tensors):
+            grid = video_grid(vid_tensor).numpy()
+            if self.streams[idx] is None:
+                stream = self.containers[idx].add_stream('h264', rate=self.fps)
+                stream.width, stream.height = grid.shape[2], grid.shape[1]
+                stream.pix_fmt = 'yuv420p'
+                stream.options = {'crf': '10'}
+                self.streams[idx] = stream
+            for img in grid:
+                frame = self.av.VideoFrame.from_ndarray(img, format='rgb24')
+                self.containers[idx].mux(self.streams[idx].encode(frame))
+
+    def close(self):
+        for container, stream in zip(self.containers, self.streams):
+            if stream is not None:
+                ## flush the frames still buffered in the encoder
+                container.mux(stream.encode())
+            container.close()
+
@@ -0,0 +1,90 @@
+import argparse, os, sys, time
+import torch
+sys.path.insert(1, os.path.join(sys.path[0], '..', '..'))
+from lvdm.modules.freepca import get_view_plan, gather_views, freepca_fuse, FUSION_BASES, FreePCAPolicy, \
+    fusion_statistics, fusion_operator, apply_fusion
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="compare the FreePCA fusion bases against the exact eigen path")
+    parser.add_argument("--features", type=str, default=None, help="torch.save'd dict of 'out' and 'com_out' windows (b, w, n, d); synthetic if not given")
+    parser.add_argument("--frames", type=int, default=64, help="frames of the synthetic long-frame features")
+    parser.add_argument("--window_sizes", type=int, nargs="+", default=[8, 16, 24], help="window sizes of the synthetic features")
+    parser.add_argument("--window_stride", type=int, default=4)
+    parser.add_argument("--rows", type=int, default=2560, help="(b h w) locations of the synthetic features")
+    parser.add_argument("--dim", type=int, default=64, help="channels per head of the synthetic features")
+    parser.add_argument("--max_components", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=10, help="timed runs per basis")
+    parser.add_argument("--chunk_size", type=int, default=256, help="rows per chunk of the chunked (Gram) fusion checked against the direct one")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", type=str, default="float32", help="{'float32', 'float16', 'bfloat16'}")
+    parser.add_argument("--seed", type=int, default=123)
+    return parser
+
+
+def synthetic_windows(args, window_size, device, dtype):
+    """
+    Long-frame output as a slow random walk over frames and short-window output as the
+    same walk with window-local noise, both clipped to the short windows: (b, w, n, d).
+    """
+    shape = (args.rows, args.frames, args.dim)
+    long_frames = torch.randn(shape, device=device).cumsum(dim=1) / args.frames ** 0.5
+    short_frames = long_frames + 0.5 * torch.randn(shape, device=device)
+    view_plan = get_view_plan(args.frames, window_size, args.window_stride)
+    out, com_out = gather_views(short_frames, view_plan.views), gather_views(long_frames, view_plan.views)
+    return out.contiguous().to(dtype), com_out.contiguous().to(dtype)
+
+
+def timed(fn, repeat, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.time()
+    for _ in range(repeat):
+        result = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return result, (time.time() - start) / repeat
+
+
+def chunked_fuse(out, com_out, selected_k, chunk_size, basis):
+    ## the fusion of CrossAttention._chunked_forward: statistics summed over row chunks, then fused chunk by chunk
+    chunks = list(zip(out.split(chunk_size), com_out.split(chunk_size)))
+    stats = sum(fusion_statistics(out_c, com_out_c) for out_c, com_out_c in chunks)
+    operator = fusion_operator(stats, selected_k, basis=basis)
+    return torch.cat([apply_fusion(out_c, com_out_c, operator) for out_c, com_out_c in chunks])
+
+
+def compare(out, com_out, max_components, repeat, chunk_size):
+    ## fuse with every basis under the model's schedule (the first window is never fused);
+    ## fidelity is measured against the exact eigen fusion
+    selected_k = FreePCAPolicy(max_components=max_components).selected_k(out.shape[1])
+    results = {}
+    for basis in FUSION_BASES:
+        fused, seconds = timed(lambda: freepca_fuse(out, com_out, selected_k, basis=basis), repeat, out.device)
+        results[basis] = (fused.float(), seconds)
+    exact = results['eigen'][0]
+    for basis, (fused, seconds) in results.items():
+        rel_error = ((fused - exact).norm() / exact.norm().clamp(min=1e-12)).item()
+        cos = torch.nn.functional.cosine_similarity(fused.flatten(2), exact.flatten(2), dim=-1).mean().item()
+        ## chunking must not change the fusion, only bound its memory
+        chunked = chunked_fuse(out, com_out, selected_k, chunk_size, basis).float()
+        chunk_error = (chunked - fused).abs().max().item()
+        print(f"  {basis:>6s}: {seconds * 1000.:8.3f} ms  rel. error {rel_error:.4e}  cosine {cos:.6f}  chunked max abs diff {chunk_error:.4e}")
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    torch.manual_seed(args.seed)
+    device, dtype = torch.device(args.device), getattr(torch, args.dtype)
+    with torch.no_grad():
+        if args.features is not None:
+            features = torch.load(args.features, map_location=device)
+            out, com_out = features['out'].to(dtype), features['com_out'].to(dtype)
+            print(f"{args.features}: windows {tuple(out.shape)}")
+            compare(out, com_out, args.max_components, args.repeat, args.chunk_size)
+        else:
+            for window_size in args.window_sizes:
+                out, com_out = synthetic_windows(args, window_size, device, dtype)
+                print(f"window {window_size}: windows {tuple(out.shape)}")
+                compare(out, com_out, args.max_components, args.repeat, args.chunk_size)
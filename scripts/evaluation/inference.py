@@ -11,8 +11,10 @@ import torch
 from pytorch_lightning import seed_everything
 
 from funcs import load_model_checkpoint, load_prompts, load_image_batch, get_filelist, save_videos
-from funcs import batch_ddim_sampling
+from funcs import batch_ddim_sampling, streaming_ddim_sampling, sampling_steps, StreamingVideoWriter
 from utils.utils import instantiate_from_config
+from lvdm.modules.attention_backends import set_attention_backend, ATTENTION_ROLES
+from lvdm.basics import prepare_for_inference
 
 
 def get_parser():
@@ -27,29 +29,91 @@ def get_parser():
     parser.add_argument("--n_samples", type=int, default=1, help="num of samples per prompt",)
     parser.add_argument("--ddim_steps", type=int, default=50, help="steps of ddim if positive, otherwise use DDPM",)
     parser.add_argument("--ddim_eta", type=float, default=1.0, help="eta for ddim sampling (0.0 yields deterministic sampling)",)
+    parser.add_argument("--sampler", type=str, default="ddim", help="{'ddim', 'dpm_solver'}, dpm_solver is deterministic and needs 15-25 steps")
     parser.add_argument("--bs", type=int, default=1, help="batch size for inference")
     parser.add_argument("--height", type=int, default=512, help="image height, in pixel space")
     parser.add_argument("--width", type=int, default=512, help="image width, in pixel space")
     parser.add_argument("--frames", type=int, default=-1, help="frames num to inference")
     parser.add_argument("--fps", type=int, default=24)
     parser.add_argument("--unconditional_guidance_scale", type=float, default=1.0, help="prompt classifier-free guidance")
+    parser.add_argument("--fused_cfg", action='store_true', default=False, help="run the conditional and unconditional passes as one batch")
+    parser.add_argument("--guidance_scale_end", type=float, default=None, help="ramp the guidance scale linearly to this at the last step")
+    parser.add_argument("--guidance_interval", type=int, nargs=2, default=None, help="START END: sampling steps with guidance, the unconditional pass is skipped outside")
     parser.add_argument("--unconditional_guidance_scale_temporal", type=float, default=None, help="temporal consistency guidance")
+    ## FreePCA short-window views
+    parser.add_argument("--window_size", type=int, default=None, help="frames per short window, defaults to the model's temporal_length")
+    parser.add_argument("--window_stride", type=int, default=None, help="frames between neighbouring short windows")
+    parser.add_argument("--blend_kernel", type=str, default=None, help="blending of overlapping windows: {'uniform', 'triangular', 'gaussian', 'cosine'}")
+    parser.add_argument("--eigenbasis_reuse", type=int, default=None, help="reuse FreePCA eigenbases for up to this many ddim steps")
+    parser.add_argument("--eigenbasis_drift", type=float, default=None, help="recompute a reused eigenbasis once its drift exceeds this")
+    parser.add_argument("--chunk_size", type=int, default=None, help="run temporal attention over chunks of this many latent locations")
+    parser.add_argument("--fuse_timestep", type=int, default=None, help="fuse short windows with the long-frame branch above this timestep")
+    parser.add_argument("--max_components", type=int, default=None, help="most long-frame principal components a window keeps")
+    parser.add_argument("--fusion_basis", type=str, default=None, help="basis of the FreePCA fusion: {'eigen', 'dct'}")
+    parser.add_argument("--keyframe_stride", type=int, default=None, help="long-frame attention keys/values from every k-th frame only")
+    parser.add_argument("--temporal_backend", type=str, default=None, help="temporal attention backend: {'xformers', 'sdpa', 'chunked', 'einsum', 'auto'}")
+    parser.add_argument("--attention_backend", type=str, nargs="*", default=[], help="role=backend pairs, roles: {'spatial_self', 'spatial_cross', 'temporal_long', 'temporal_window'}")
+    parser.add_argument("--autotune_attention", action='store_true', default=False, help="benchmark the attention backends of every role on the first calls and keep the fastest")
+    ## streaming generation of videos of any length
+    parser.add_argument("--streaming", action='store_true', default=False, help="denoise a rolling working set and write frames as they finish")
+    parser.add_argument("--stream_window", type=int, default=64, help="frames in the working set denoised at once")
+    parser.add_argument("--stream_context", type=int, default=16, help="last generated frames kept in the working set")
+    parser.add_argument("--stream_memory", type=int, default=16, help="keyframes of older frames kept in the working set")
+    parser.add_argument("--stream_memory_stride", type=int, default=8, help="frames between keyframes before the memory fills up")
     ## for conditional i2v only
     parser.add_argument("--cond_input", type=str, default=None, help="data dir of conditional input")
     return parser
 
 
+def freepca_noise(n_samples, bs, channels, frames, h, w, window=16, device=None):
+    ## initial noise (n_samples, bs, c, frames, h, w); every window reuses the mean statistics of the one before it
+    # ----------------------Noise Init Begin----------------------------------
+
+    x_T_total = torch.randn([n_samples, 1, channels, frames, h, w], device=device).repeat(1, bs, 1, 1, 1, 1)
+    
+    for frame_index in range(window, frames - window + 1, window):  # frame_index is 16, 32, 48 for 64 frames
+        list_index = list(range(frame_index-window, frame_index))
+        random.shuffle(list_index)
+        # ------------------Reuse Mean Statistics---------------------------
+        f_out = x_T_total[:, :, :, list_index]
+        a_out = x_T_total[:, :, :, frame_index:frame_index + window]
+
+        norm_mean = torch.mean(f_out, dim=3).unsqueeze(3).repeat(1, 1, 1, window, 1, 1)
+        com_mean = torch.mean(a_out, dim=3).unsqueeze(3).repeat(1, 1, 1, window, 1, 1)
+        com_res = a_out-com_mean  
+        x_T_total[:, :, :, frame_index:frame_index + window] = norm_mean + com_res
+    # ----------------------Noise Init End----------------------------------
+    return x_T_total
+
+
 def run_inference(args, gpu_num, gpu_no, **kwargs):
+    kwargs.update({"fused_cfg": args.fused_cfg, "sampler": args.sampler})
+    kwargs.update({"guidance_interval": args.guidance_interval})
     ## step 1: model config
     ## -----------------------------------------------------------------
     config = OmegaConf.load(args.config)
     #data_config = config.pop("data", OmegaConf.create())
     model_config = config.pop("model", OmegaConf.create())
+    for key in ["window_size", "window_stride", "blend_kernel", "eigenbasis_reuse", "eigenbasis_drift", "chunk_size", "temporal_backend",
+                "fuse_timestep", "max_components", "fusion_basis", "keyframe_stride"]:
+        if getattr(args, key) is not None:
+            OmegaConf.update(model_config, f"params.unet_config.params.freepca_config.{key}", getattr(args, key), merge=True)
+    ## attention backends per role, selected before the first forward
+    if args.autotune_attention:
+        for role in ATTENTION_ROLES:
+            set_attention_backend(role, 'auto')
+    for pair in args.attention_backend:
+        role, name = pair.split('=')
+        set_attention_backend(role, name)
     model = instantiate_from_config(model_config)
     model = model.cuda(1)
     assert os.path.exists(args.ckpt_path), f"Error: checkpoint [{args.ckpt_path}] Not Found!"
     model = load_model_checkpoint(model, args.ckpt_path)
-    model.eval()
+    model = prepare_for_inference(model)
+    cfg_scale = args.unconditional_guidance_scale
+    if args.guidance_scale_end is not None:
+        ## one scale per step the sampler actually runs, which can be more than ddim_steps
+        cfg_scale = np.linspace(cfg_scale, args.guidance_scale_end, sampling_steps(model, args.ddim_steps, args.sampler)).tolist()
 
     ## sample shape
     assert (args.height % 16 == 0) and (args.width % 16 == 0), "Error: image size [h,w] should be multiples of 16!"
@@ -92,22 +156,10 @@ def run_inference(args, gpu_num, gpu_no, **kwargs):
     n_rounds = len(prompt_list_rank) // args.bs
     n_rounds = n_rounds+1 if len(prompt_list_rank) % args.bs != 0 else n_rounds
     
-    # ----------------------Noise Init Begin----------------------------------
-
-    x_T_total = torch.randn([args.n_samples, 1, channels, frames, h, w], device=model.device).repeat(1, args.bs, 1, 1, 1, 1)
-    
-    for frame_index in range(16, 64, 16):  # frame_index is 16, 32, 48
-        list_index = list(range(frame_index-16, frame_index))
-        random.shuffle(list_index)
-        # ------------------Reuse Mean Statistics---------------------------
-        f_out = x_T_total[:, :, :, list_index]
-        a_out = x_T_total[:, :, :, frame_index:frame_index + 16]
-
-        norm_mean = torch.mean(f_out, dim=3).unsqueeze(3).repeat(1, 1, 1, 16, 1, 1)
-        com_mean = torch.mean(a_out, dim=3).unsqueeze(3).repeat(1, 1, 1, 16, 1, 1)
-        com_res = a_out-com_mean  
-        x_T_total[:, :, :, frame_index:frame_index + 16] = norm_mean + com_res
-    # ----------------------Noise Init End----------------------------------
+    ## streaming: only the working set is ever held, however many frames are asked for
+    window_frames = min(args.stream_window, frames) if args.streaming else frames
+    init_noise = partial(freepca_noise, args.n_samples, args.bs, channels, h=h, w=w, window=model.temporal_length, device=model.device)
+    x_T_total = None if args.streaming else init_noise(frames)
 
 
     for idx in range(0, n_rounds):
@@ -116,7 +168,7 @@ def run_inference(args, gpu_num, gpu_no, **kwargs):
         idx_e = min(idx_s+args.bs, len(prompt_list_rank))
         batch_size = idx_e - idx_s
         filenames = filename_list_rank[idx_s:idx_e]
-        noise_shape = [batch_size, channels, frames, h, w]
+        noise_shape = [batch_size, channels, window_frames, h, w]
         fps = torch.tensor([args.fps]*batch_size).to(model.device).long()
 
         prompts = prompt_list_rank[idx_s:idx_e]
@@ -138,8 +190,18 @@ def run_inference(args, gpu_num, gpu_no, **kwargs):
             raise NotImplementedError
 
         ## inference
+        if args.streaming:
+            writer = StreamingVideoWriter(args.savedir, filenames, fps=args.savefps)
+            for batch_segment in streaming_ddim_sampling(model, cond, noise_shape, frames, args.n_samples, \
+                                                            args.ddim_steps, args.ddim_eta, cfg_scale, \
+                                                            noise_fn=init_noise, context_frames=args.stream_context, \
+                                                            memory_frames=args.stream_memory, memory_stride=args.stream_memory_stride, **kwargs):
+                ## b,samples,c,t,h,w
+                writer.write(batch_segment)
+            writer.close()
+            continue
         batch_samples = batch_ddim_sampling(model, cond, noise_shape, args.n_samples, \
-                                                args.ddim_steps, args.ddim_eta, args.unconditional_guidance_scale, args=args, x_T_total=x_T_total, **kwargs)
+                                                args.ddim_steps, args.ddim_eta, cfg_scale, args=args, x_T_total=x_T_total, **kwargs)
         ## b,samples,c,t,h,w
         save_videos(batch_samples, args.savedir, filenames, fps=args.savefps)
 
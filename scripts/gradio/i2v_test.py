@@ -4,6 +4,7 @@ from omegaconf import OmegaConf
 import torch
 from scripts.evaluation.funcs import load_model_checkpoint, load_image_batch, save_videos, batch_ddim_sampling
 from utils.utils import instantiate_from_config
+from lvdm.basics import prepare_for_inference
 from huggingface_hub import hf_hub_download
 
 class Image2Video():
@@ -23,7 +24,7 @@ class Image2Video():
             # model = model.cuda(gpu_id)
             assert os.path.exists(ckpt_path), "Error: checkpoint Not Found!"
             model = load_model_checkpoint(model, ckpt_path)
-            model.eval()
+            model = prepare_for_inference(model)
             model_list.append(model)
         self.model_list = model_list
         self.save_fps = 8